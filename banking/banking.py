@@ -1,11 +1,19 @@
 import os
 import json
+import shutil
 import pathlib
+import time
+import threading
+import weakref
+from collections import OrderedDict
 from functools import wraps
+from contextlib import contextmanager
 import logging
 from random import randint
 import numpy as np
 
+from banking import events
+
 
 #Setting file path globally
 file_path = pathlib.Path.home()/'Desktop'/'Springboard Bootcamp'/'Banking Mini Project'/'data'
@@ -25,6 +33,19 @@ loghandler.setFormatter(formatter)
 
 logger.addHandler(loghandler)
 
+#Card authorization decisions are kept in their own log for review, one json object per line
+risk_logger = logging.getLogger(__name__ + '.risk')
+risk_logger.setLevel(logging.INFO)
+risk_logger.propagate = False
+
+pathlib.Path.touch(file_path.parent/'logs'/'risk.log')
+
+riskhandler = logging.FileHandler(file_path.parent/'logs'/'risk.log')
+riskhandler.setLevel(logging.INFO)
+riskhandler.setFormatter(formatter)
+
+risk_logger.addHandler(riskhandler)
+
 
 def json_load(file):
     '''
@@ -37,6 +58,9 @@ def json_load(file):
         dict: loaded json data
 
     '''
+    pending = getattr(_batch, 'pending', None)
+    if pending is not None and file in pending:
+        return pending[file]
     if file not in file_path.glob('*.json'):
         logging.error(ValueError(f'A bank with name {file.stem} does not exist'))
         raise ValueError(f'A bank with name {file.stem} does not exist')
@@ -44,19 +68,745 @@ def json_load(file):
         data = json.load(f) 
     return data
 
-def json_write(file, data):
+def json_write(file, data, changed=None):
     '''
     Writes contents of {data} to the json file at {file}
 
     Args:
         file (obj) : pathlib Path object of file location
         data (dict): data to be loaded
+        changed (list, optional) : the ids of the records of {data} that changed, defaults to None for a change to
+                                   the whole file
     '''
-    with file.open('w') as f:
-        f.seek(0)
-        f.truncate()
+    pending = getattr(_batch, 'pending', None)
+    if pending is not None:
+        #A batch logs only the records each of its writes changes, so it can be redone after a crash
+        if changed is None:
+            _batch.files.add(file)
+        elif file not in _batch.files:
+            _batch.records.setdefault(file, set()).update(str(key) for key in changed)
+        pending[file] = data
+        return
+    #Written beside the file and moved into place, so a crash never leaves a half written file behind
+    temp = file.with_name(file.name + '.tmp')
+    with temp.open('w') as f:
         json.dump(data, f)
-        
+    os.replace(temp, file)
+
+
+#Writes made inside a batch() block are held per thread and written once when the block ends
+_batch = threading.local()
+
+@contextmanager
+def batch():
+    '''
+    Groups every write made inside the block into a single commit, each file touched is written once when the block ends.
+    Reads inside the block see the pending writes. Nested blocks join the outermost one. Each bank's changed records
+    and its events are staged in its event outbox before any file is written, and the events are published once the
+    writes they describe are on disk. Once staged the block is committed: a crash or a failed write part way through
+    is redone from the outbox, straight away or when the bank is next used. A block that fails before it is staged
+    writes nothing, objects it changed keep their changes in memory until the bank is closed and read again.
+    '''
+    if getattr(_batch, 'pending', None) is not None:
+        yield
+        return
+    _batch.pending = {}
+    _batch.records = {}
+    _batch.files = set()
+    _batch.events = []
+    try:
+        yield
+    finally:
+        pending, _batch.pending = _batch.pending, None
+        records, files = _batch.records, _batch.files
+        queued, _batch.events = _batch.events, None
+        #Grouped by bank, a shard lives in the bank's folder and the manifest beside it
+        outboxes = {}
+        for file, data in pending.items():
+            if file in files:
+                change = {'File':file, 'Data':data}
+            else:
+                change = {'File':file, 'Records':{key:data.get(key) for key in records[file]}}
+            directory = file.parent if file.parent != file_path else file_path/file.stem
+            outboxes.setdefault(directory, ([], []))[0].append(change)
+        for bank_name, event_type, data in queued:
+            outboxes.setdefault(file_path/bank_name, ([], []))[1].append(events.change(bank_name, event_type, data))
+        staged = []
+        try:
+            for directory, (changes, published) in outboxes.items():
+                events.stream(directory).stage(published, changes)
+                staged.append(directory)
+        except BaseException:
+            #No file of the batch is written yet, so it is dropped whole
+            for directory in staged:
+                events.stream(directory).discard()
+            raise
+        written = True
+        try:
+            for file, data in pending.items():
+                json_write(file, data)
+        except Exception as e:
+            written = False
+            logger.error(f'A batch failed to write its files, they are written again from the outbox: {e}')
+        for directory in outboxes:
+            try:
+                published = events.stream(directory).release() if written else events.stream(directory).redo()
+            except Exception as e:
+                logger.error(f'A batch could not be finished, it is redone when {directory.name} is next used: {e}')
+                continue
+            for event in published:
+                events.notify(event)
+
+def batched(method):
+    '''Runs {method} inside batch(), so the writes it makes and the events it publishes are committed together'''
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        with batch():
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def publish(bank_name, event_type, data):
+    '''
+    Publishes a change to the bank's event stream and the in process subscribers, see banking.events
+
+    Args:
+        bank_name (str) : The name of the bank
+        event_type (str) : The event type, e.g. balance_changed
+        data (dict) : The event data
+    '''
+    queued = getattr(_batch, 'events', None)
+    if queued is not None:
+        queued.append((bank_name, event_type, data))
+        return
+    events.publish(file_path/bank_name, bank_name, event_type, data)
+
+
+#Bank storage is split into a manifest file ({bank}.json) and a directory of shard files ({bank}/).
+#Each entity type is hashed into shard files by its id, so an operation only rewrites the one shard holding its record.
+#An entity type starts with {shards} files and doubles them whenever it grows past RECORDS_PER_SHARD records a shard,
+#so the shard an operation rewrites stays the same size however large the bank grows
+ENTITIES = ['Customers', 'Accounts', 'Credit Cards', 'Loans']
+FIRST_IDS = {'Customers':10001, 'Accounts':90001, 'Credit Cards':1234123412340001, 'Loans':1}
+ID_FIELDS = {'Customers':'Customer Id', 'Accounts':'Account Id', 'Credit Cards':'Card Number', 'Loans':'Loan Id'}
+DEFAULT_SHARDS = 16
+RECORDS_PER_SHARD = 512
+
+
+def shard_file(bank_name, entity, key, shards):
+    '''
+    Gets the shard file holding the record {key} of type {entity}
+
+    Args:
+        bank_name (str) : The name of the bank
+        entity (str) : The entity type, one of ENTITIES or 'SSNs' for the customer ssn index
+        key (int) : The id of the record
+        shards (int) : The number of shards per entity type in the bank
+
+    Returns:
+        obj: pathlib Path object of the shard file
+    '''
+    return file_path/bank_name/'{}-{:03d}.json'.format(entity.lower().replace(' ', '_'), int(key) % shards)
+
+def shard_load(file):
+    '''
+    Loads the shard at {file}, a shard that has not been written yet is empty
+
+    Args:
+        file (obj) : pathlib Path object of the shard file
+
+    Returns:
+        dict: records in the shard keyed by their id as a string
+    '''
+    pending = getattr(_batch, 'pending', None)
+    if pending is not None and file in pending:
+        return pending[file]
+    if not file.exists():
+        return {}
+    with file.open('r') as f:
+        data = json.load(f)
+    return data
+
+def record_load(bank_name, entity, key):
+    '''
+    Loads the record {key} of type {entity}, from its shard or else from the snapshot the bank was restored from
+
+    Args:
+        bank_name (str) : The name of the bank
+        entity (str) : The entity type
+        key (int) : The id of the record
+
+    Returns:
+        The record, or None if the bank has no record with that id
+    '''
+    record = shard_load(record_file(bank_name, entity, key)).get(str(key))
+    if record is None and snapshot_base(bank_name) is not None:
+        record = snapshot_base(bank_name).record(entity, key)
+    return record
+
+def record_update(bank_name, entity, key, fields):
+    '''
+    Updates the record {key} of type {entity} in its shard with {fields}, creating the record if it does not exist.
+    A record still only held in the bank's snapshot is copied into its shard first.
+
+    Args:
+        bank_name (str) : The name of the bank
+        entity (str) : The entity type
+        key (int) : The id of the record
+        fields (dict) : Fields to be written to the record
+    '''
+    file = record_file(bank_name, entity, key)
+    data = shard_load(file)
+    if str(key) not in data and snapshot_base(bank_name) is not None:
+        data[str(key)] = snapshot_base(bank_name).record(entity, key) or {}
+    data.setdefault(str(key), {}).update(fields)
+    json_write(file, data, [key])
+
+def shard_view(bank_name, entity, index, shards):
+    '''
+    Loads shard {index} of {shards} of type {entity}, along with the records of the bank's snapshot that hash to it
+    and have not been written since
+
+    Args:
+        bank_name (str) : The name of the bank
+        entity (str) : The entity type
+        index (int) : The index of the shard
+        shards (int) : The number of shards of type {entity}
+
+    Returns:
+        dict: records keyed by their id as a string
+    '''
+    records = shard_load(shard_file(bank_name, entity, index, shards))
+    if snapshot_base(bank_name) is not None:
+        records = {**snapshot_base(bank_name).records(entity, index, shards), **records}
+    return records
+
+def shard_records(bank_name, entity, written=False):
+    '''
+    Loads every record of type {entity} in the bank, reading all of its shards
+
+    Args:
+        bank_name (str) : The name of the bank
+        entity (str) : The entity type
+        written (bool, optional) : Only the records written to the shards, leaving out those still only held in the
+                                   snapshot the bank was restored from, defaults to False
+
+    Returns:
+        list: records sorted by id
+    '''
+    records = {}
+    shards = entity_shards(bank_name, entity)
+    for index in range(shards):
+        if written:
+            records.update(shard_load(shard_file(bank_name, entity, index, shards)))
+        else:
+            records.update(shard_view(bank_name, entity, index, shards))
+    return [records[key] for key in sorted(records, key=int)]
+
+def next_id(bank_name, entity):
+    '''
+    Takes the next free id of type {entity} from the bank manifest, splitting the entity's shards if it has outgrown them
+
+    Args:
+        bank_name (str) : The name of the bank
+        entity (str) : The entity type
+
+    Returns:
+        int: the new id
+    '''
+    file = file_path/f'{bank_name}.json'
+    manifest = json_load(file)
+    new_id = manifest['Next Id'][entity]
+    manifest['Next Id'][entity] = new_id + 1
+    records = new_id - FIRST_IDS[entity] + 1
+    #The ssn index holds one record per customer and splits along with the customers
+    for split in [entity] + (['SSNs'] if entity == 'Customers' else []):
+        shards = manifest.get('Entity Shards', {}).get(split, manifest['Shards'])
+        if records > shards * RECORDS_PER_SHARD:
+            shard_split(bank_name, manifest, split)
+    json_write(file, manifest)
+    return new_id
+
+#Number of shards of each entity type of each bank in use, read from its manifest when first needed
+_SHARD_COUNTS = {}
+
+def entity_shards(bank_name, entity):
+    '''
+    Gets the number of shards holding the records of type {entity}
+
+    Args:
+        bank_name (str) : The name of the bank
+        entity (str) : The entity type
+
+    Returns:
+        int: the number of shards
+    '''
+    if bank_name not in _SHARD_COUNTS:
+        manifest = json_load(file_path/f'{bank_name}.json')
+        _SHARD_COUNTS[bank_name] = {entity:manifest['Shards'] for entity in ENTITIES + ['SSNs']}
+        _SHARD_COUNTS[bank_name].update(manifest.get('Entity Shards', {}))
+    return _SHARD_COUNTS[bank_name][entity]
+
+def record_file(bank_name, entity, key):
+    '''
+    Gets the shard file currently holding the record {key} of type {entity}
+
+    Args:
+        bank_name (str) : The name of the bank
+        entity (str) : The entity type
+        key (int) : The id of the record
+
+    Returns:
+        obj: pathlib Path object of the shard file
+    '''
+    return shard_file(bank_name, entity, key, entity_shards(bank_name, entity))
+
+#Snapshot each bank in use was restored from, read from its manifest when first needed, None if it has none
+_SNAPSHOT_BASES = {}
+
+def snapshot_base(bank_name):
+    '''
+    Gets the snapshot the bank was restored from. Its records are read from the mapped snapshot until they are first
+    written, so a restored bank does not have to write its whole book out as shards.
+
+    Args:
+        bank_name (str) : The name of the bank
+
+    Returns:
+        obj: SnapshotBase Class Object, or None if the bank was not restored from a snapshot
+    '''
+    if bank_name not in _SNAPSHOT_BASES:
+        manifest = json_load(file_path/f'{bank_name}.json')
+        _SNAPSHOT_BASES[bank_name] = None
+        if 'Snapshot' in manifest:
+            #Imported here as banking.snapshot is built on this module
+            from banking.snapshot import SnapshotBase
+            _SNAPSHOT_BASES[bank_name] = SnapshotBase(file_path/bank_name/manifest['Snapshot'])
+    return _SNAPSHOT_BASES[bank_name]
+
+def shard_split(bank_name, manifest, entity):
+    '''
+    Doubles the number of shards of type {entity}. Shard i keeps the records that still hash to it and moves the rest
+    to shard i+n. The new shards are written before the manifest and the old shards after, so a crash part way never
+    leaves a record where lookups cannot find it. The caller writes the manifest.
+
+    Args:
+        bank_name (str) : The name of the bank
+        manifest (dict) : The bank manifest, updated with the new number of shards
+        entity (str) : The entity type
+    '''
+    shards = manifest.get('Entity Shards', {}).get(entity, manifest['Shards'])
+    kept = {}
+    for index in range(shards):
+        old = shard_load(shard_file(bank_name, entity, index, shards))
+        moved = {key:record for key, record in old.items() if int(key) % (2*shards) != index}
+        json_write(shard_file(bank_name, entity, index + shards, 2*shards), moved)
+        kept[index] = {key:record for key, record in old.items() if key not in moved}
+    manifest.setdefault('Entity Shards', {})[entity] = 2*shards
+    json_write(file_path/f'{bank_name}.json', manifest)
+    if bank_name in _SHARD_COUNTS:
+        _SHARD_COUNTS[bank_name][entity] = 2*shards
+    for index, records in kept.items():
+        json_write(shard_file(bank_name, entity, index, shards), records)
+    logger.info(f'Bank {bank_name} split its {entity} into {2*shards} shards')
+
+#Current month of each open bank. Interest is accrued lazily, each savings account and credit card stores the last
+#month it accrued and catches up to its bank's month the next time it is read or written
+_PERIODS = {}
+
+def bank_period(bank_name):
+    '''
+    Gets the current month of the bank, counted from when it was created
+
+    Args:
+        bank_name (str) : The name of the bank
+
+    Returns:
+        int: the number of month ends the bank has gone through
+    '''
+    if bank_name in _PERIODS:
+        return _PERIODS[bank_name]
+    return json_load(file_path/f'{bank_name}.json').get('Period', 0)
+
+
+class SlidingWindow:
+    '''
+    Running total over the last {seconds} seconds, kept in a ring of {buckets} time buckets.
+    Adding and reading cost O(buckets) at most and usually O(1), and old values expire a bucket at a time.
+
+    Attributes:
+        seconds (float) : The length of the window
+        buckets (int, optional) : The number of buckets the window is split into, defaults to 60
+
+    Methods:
+        add : adds a value at a time
+        total : gets the total of the window ending at a time
+    '''
+    def __init__(self, seconds, buckets=60):
+        '''
+        SlidingWindow object initialization function
+
+        Args:
+            seconds (float) : The length of the window
+            buckets (int, optional) : The number of buckets the window is split into, defaults to 60
+        '''
+        self._width = seconds / buckets
+        self._counts = [0]*buckets
+        self._newest = 0
+        self._total = 0
+
+    def _advance(self, now):
+        '''Expires the buckets that have fallen out of the window ending at {now}'''
+        newest = int(now // self._width)
+        if newest - self._newest >= len(self._counts):
+            self._counts = [0]*len(self._counts)
+            self._total = 0
+        else:
+            for bucket in range(self._newest+1, newest+1):
+                self._total -= self._counts[bucket % len(self._counts)]
+                self._counts[bucket % len(self._counts)] = 0
+        self._newest = max(newest, self._newest)
+
+    def add(self, now, value=1):
+        '''Adds {value} at time {now}'''
+        self._advance(now)
+        self._counts[self._newest % len(self._counts)] += value
+        self._total += value
+
+    def total(self, now):
+        '''Gets the total of the window ending at time {now}'''
+        self._advance(now)
+        return self._total
+
+
+class RiskRules:
+    '''
+    Authorization time risk limits for credit card purchases at a bank, a limit of None is not checked
+
+    Attributes:
+        purchases_per_minute (int, optional) : The most purchases a card may make in a minute, defaults to 10
+        amount_per_hour (float, optional) : The most a card may spend in an hour, defaults to 5000
+        cvv_failures (int, optional) : Failed CVV attempts in an hour before a card is locked, defaults to 3
+    '''
+    def __init__(self, purchases_per_minute=10, amount_per_hour=5000, cvv_failures=3):
+        '''
+        RiskRules object initialization function
+
+        Args:
+            purchases_per_minute (int, optional) : The most purchases a card may make in a minute, defaults to 10
+            amount_per_hour (float, optional) : The most a card may spend in an hour, defaults to 5000
+            cvv_failures (int, optional) : Failed CVV attempts in an hour before a card is locked, defaults to 3
+        '''
+        self.purchases_per_minute = purchases_per_minute
+        self.amount_per_hour = amount_per_hour
+        self.cvv_failures = cvv_failures
+
+    def to_dict(self):
+        '''Gets the rules in the form stored in the bank manifest'''
+        return {'Purchases Per Minute':self.purchases_per_minute, 'Amount Per Hour':self.amount_per_hour, 'CVV Failures':self.cvv_failures}
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Builds rules from the form stored in the bank manifest'''
+        return cls(data['Purchases Per Minute'], data['Amount Per Hour'], data['CVV Failures'])
+
+#Risk rules of each bank in use, read from its manifest when first needed. Banks without their own rules use the defaults
+_RISK_RULES = {}
+
+def risk_rules(bank_name):
+    '''
+    Gets the risk rules of the bank, read from the bank manifest if the bank is not open
+
+    Args:
+        bank_name (str) : The name of the bank
+
+    Returns:
+        RiskRules Class Object
+    '''
+    if bank_name not in _RISK_RULES:
+        manifest = json_load(file_path/f'{bank_name}.json')
+        _RISK_RULES[bank_name] = RiskRules.from_dict(manifest['Risk Rules']) if 'Risk Rules' in manifest else RiskRules()
+    return _RISK_RULES[bank_name]
+
+
+#Loaded customers, accounts and credit cards are held per bank by weak reference, so objects nobody uses can be
+#garbage collected and unloading a bank only touches that bank's objects
+KEEP_LOADED = 1024
+
+
+class Registry:
+    '''
+    Weak references to the loaded customers, accounts and credit cards of one bank, keyed by id. The {keep} most
+    recently used objects are also held strongly. Any other object nobody holds is garbage collected and loaded again
+    from the bank database the next time it is looked up, which is safe because every change is written as it is made.
+
+    Attributes:
+        bank_name (str) : The name of the bank
+        shards (int, optional) : The number of shard files per entity type, defaults to None to read it from the manifest
+        keep (int, optional) : The number of recently used objects held strongly, defaults to KEEP_LOADED
+
+    Methods:
+        add : registers a loaded object
+        get : gets an object, loading it from the bank database if it is not loaded
+        evict : drops an object from the registry
+        velocity : gets the risk check sliding windows of a credit card
+        prune : drops the sliding windows of credit cards with no recent activity
+        clear : drops every object of the bank
+    '''
+    def __init__(self, bank_name, keep=KEEP_LOADED):
+        '''
+        Registry object initialization function
+
+        Args:
+            bank_name (str) : The name of the bank
+            keep (int, optional) : The number of recently used objects held strongly, defaults to KEEP_LOADED
+        '''
+        self._bank_name = bank_name
+        self._keep = keep
+        self._objects = {entity:weakref.WeakValueDictionary() for entity in ['Customers', 'Accounts', 'Credit Cards']}
+        self._recent = OrderedDict()
+        #Risk check windows outlive the card objects, so a card being collected never resets its limits
+        self._velocity = {}
+
+    def __len__(self):
+        '''Gets the number of loaded objects'''
+        return sum(len(objects) for objects in self._objects.values())
+
+    def add(self, entity, key, obj):
+        '''
+        Registers a loaded object
+
+        Args:
+            entity (str) : The entity type, Customers, Accounts or Credit Cards
+            key (int) : The customer id, account id or card number
+            obj (obj) : The object
+        '''
+        self._objects[entity][key] = obj
+        self._use(entity, key, obj)
+
+    def get(self, entity, key):
+        '''
+        Gets an object, loading it from the bank database if it is not loaded
+
+        Args:
+            entity (str) : The entity type, Customers, Accounts or Credit Cards
+            key (int) : The customer id, account id or card number
+
+        Returns:
+            obj: the object, or None if the bank has no record with that id
+        '''
+        obj = self._objects[entity].get(key)
+        if obj is not None:
+            self._use(entity, key, obj)
+            return obj
+        record = record_load(self._bank_name, entity, key)
+        if record is None:
+            return None
+        if entity == 'Customers':
+            return Customer._from_record(self._bank_name, record)
+        if entity == 'Accounts':
+            return (SavingsAccount if record.get('Type') == 'S' else CheckingAccount)._from_record(self._bank_name, record)
+        return CreditCard._from_record(self._bank_name, record)
+
+    def _use(self, entity, key, obj):
+        '''Marks an object as the most recently used, dropping the strong reference to the least recently used'''
+        self._recent[entity, key] = obj
+        self._recent.move_to_end((entity, key))
+        if len(self._recent) > self._keep:
+            self._recent.popitem(last=False)
+
+    def evict(self, entity, key):
+        '''
+        Drops an object from the registry, the next lookup loads it again from the bank database
+
+        Args:
+            entity (str) : The entity type, Customers, Accounts or Credit Cards
+            key (int) : The customer id, account id or card number
+        '''
+        self._objects[entity].pop(key, None)
+        self._recent.pop((entity, key), None)
+
+    def velocity(self, card_number):
+        '''
+        Gets the risk check sliding windows of a credit card
+
+        Args:
+            card_number (int) : The card number
+
+        Returns:
+            dict: the purchases, amount and CVV failures windows
+        '''
+        if card_number not in self._velocity:
+            self._velocity[card_number] = {'Purchases':SlidingWindow(60), 'Amount':SlidingWindow(3600), 'CVV Failures':SlidingWindow(3600)}
+        return self._velocity[card_number]
+
+    def prune(self):
+        '''
+        Drops the sliding windows of credit cards with nothing left in them
+
+        Returns:
+            int: the number of cards pruned
+        '''
+        now = time.monotonic()
+        idle = [card_number for card_number, windows in self._velocity.items() if not any(window.total(now) for window in windows.values())]
+        for card_number in idle:
+            del self._velocity[card_number]
+        return len(idle)
+
+    def clear(self):
+        '''Drops every object of the bank'''
+        for objects in self._objects.values():
+            objects.clear()
+        self._recent.clear()
+        self._velocity.clear()
+
+
+_REGISTRIES = {}
+
+def registry(bank_name):
+    '''
+    Gets the registry of the bank's loaded objects
+
+    Args:
+        bank_name (str) : The name of the bank
+
+    Returns:
+        Registry Class Object
+    '''
+    if bank_name not in _REGISTRIES:
+        _REGISTRIES[bank_name] = Registry(bank_name)
+    return _REGISTRIES[bank_name]
+
+
+class LoadedObjects:
+    '''
+    Read only view of the loaded objects of one type across every bank, in place of the class lists they were once kept in
+
+    Attributes:
+        entity (str) : The entity type, Customers, Accounts or Credit Cards
+        type (str, optional) : The account type, 'S' or 'C', defaults to None for every object of the entity type
+    '''
+    def __init__(self, entity, type=None):
+        '''
+        LoadedObjects object initialization function
+
+        Args:
+            entity (str) : The entity type, Customers, Accounts or Credit Cards
+            type (str, optional) : The account type, 'S' or 'C', defaults to None for every object of the entity type
+        '''
+        self._entity = entity
+        self._type = type
+
+    def __iter__(self):
+        '''Iterates over the loaded objects'''
+        for bank_registry in list(_REGISTRIES.values()):
+            for obj in list(bank_registry._objects[self._entity].values()):
+                if self._type is None or obj._type == self._type:
+                    yield obj
+
+    def __len__(self):
+        '''Gets the number of loaded objects'''
+        return sum(1 for _ in self)
+
+    def __add__(self, other):
+        '''Joins the loaded objects with another view or list'''
+        return list(self) + list(other)
+
+    def __repr__(self):
+        '''Returns a list representation of the loaded objects'''
+        return repr(list(self))
+
+def bank_export(bank_name, written=False):
+    '''
+    Reads a whole bank into the single file layout, with a list of records for each entity type, the bank's period
+    and its risk rules if it has its own
+
+    Args:
+        bank_name (str) : The name of the bank
+        written (bool, optional) : Only the records written to the bank's shards, leaving out those still only held in
+                                   the snapshot it was restored from, defaults to False
+
+    Returns:
+        dict: bank data
+    '''
+    manifest = json_load(file_path/f'{bank_name}.json')
+    data = {'Bank Name':bank_name, 'Period':manifest.get('Period', 0)}
+    if 'Risk Rules' in manifest:
+        data['Risk Rules'] = manifest['Risk Rules']
+    for entity in ENTITIES:
+        data[entity] = shard_records(bank_name, entity, written)
+    return data
+
+def bank_import(data, shards=DEFAULT_SHARDS):
+    '''
+    Writes bank data in the single file layout to a new sharded bank, also used to migrate an old {bank}.json file
+
+    Args:
+        data (dict) : bank data with a list of records for each entity type
+        shards (int, optional) : The number of shards per entity type, defaults to DEFAULT_SHARDS
+    '''
+    bank_name = data['Bank Name']
+    manifest = bank_layout(bank_name, shards, {entity:len(data.get(entity, [])) for entity in ENTITIES},
+                           data.get('Period', 0), data.get('Risk Rules'))
+    counts = {entity:manifest['Entity Shards'].get(entity, shards) for entity in ENTITIES + ['SSNs']}
+    files = {}
+    for entity in ENTITIES:
+        for record in data.get(entity, []):
+            key = record[ID_FIELDS[entity]]
+            files.setdefault(shard_file(bank_name, entity, key, counts[entity]), {})[str(key)] = record
+    for cust in data.get('Customers', []):
+        files.setdefault(shard_file(bank_name, 'SSNs', cust['SSN'], counts['SSNs']), {})[str(cust['SSN'])] = cust['Customer Id']
+    for entity in ENTITIES:
+        ids = [record[ID_FIELDS[entity]] for record in data.get(entity, [])]
+        if ids:
+            manifest['Next Id'][entity] = max(ids)+1
+
+    for file, records in files.items():
+        json_write(file, records)
+    json_write(file_path/f'{bank_name}.json', manifest)
+    logger.info(f'Bank {bank_name} imported into {shards} shards per entity type')
+
+def bank_layout(bank_name, shards, rows, period=0, rules=None):
+    '''
+    Closes and clears any bank stored under {bank_name} for a new bank to be written in its place, and builds the new bank's
+    manifest with each entity type split into enough shards for {rows} records. The caller writes the manifest
+    once the bank's records are in place.
+
+    Args:
+        bank_name (str) : The name of the bank
+        shards (int) : The number of shards each entity type starts with
+        rows (dict) : The number of records of each entity type
+        period (int, optional) : The month the bank is on, defaults to 0
+        rules (dict, optional) : The bank's risk rules in the form stored in the manifest, defaults to None for the
+                                 default rules
+
+    Returns:
+        dict: the bank manifest
+    '''
+    rows = dict(rows, SSNs=rows.get('Customers', 0))
+    counts = {entity:shards for entity in ENTITIES + ['SSNs']}
+    for entity in counts:
+        while rows.get(entity, 0) > counts[entity] * RECORDS_PER_SHARD:
+            counts[entity] *= 2
+
+    #A bank of the same name open in this process is closed, so none of its loaded objects or settings outlive it
+    for bank in [bank for bank in Bank.__BANKS__ if bank.name == bank_name]:
+        bank.close()
+    bank_registry = _REGISTRIES.pop(bank_name, None)
+    if bank_registry is not None:
+        bank_registry.clear()
+    _PERIODS.pop(bank_name, None)
+    _RISK_RULES.pop(bank_name, None)
+    events.close_stream(file_path/bank_name)
+    _SHARD_COUNTS.pop(bank_name, None)
+    _SNAPSHOT_BASES.pop(bank_name, None)
+    shutil.rmtree(file_path/bank_name, ignore_errors=True)
+    (file_path/bank_name).mkdir(parents=True)
+    manifest = {'Bank Name':bank_name, 'Shards':shards, 'Entities':ENTITIES, 'Next Id':dict(FIRST_IDS), 'Period':period,
+                'Entity Shards':{entity:count for entity, count in counts.items() if count != shards}}
+    if rules is not None:
+        manifest['Risk Rules'] = rules
+    return manifest
 
 
 class Bank:
@@ -70,15 +820,26 @@ class Bank:
     Methods:
         name : gets name
         file : gets file path
-        next_month : applys interest to all savings accounts and credit cards within the bank
+        open : opens an existing bank and loads its objects from the bank database
+        risk_rules : gets or sets the credit card risk rules
+        events : gets the bank's event stream
+        customer : gets a customer, loading it from the bank database if needed
+        account : gets an account, loading it from the bank database if needed
+        card : gets a credit card, loading it from the bank database if needed
+        evict : unloads one customer, account or credit card
+        close : unloads the bank objects while keeping the bank database
+        destroy : closes the bank and deletes its bank database
+        next_month : moves the bank to the next month, savings accounts and credit cards accrue it when next used
+        sweep : catches up savings accounts and credit cards that have not been used since the last month end
     '''
     __BANKS__ = []
-    def __init__(self, name):
+    def __init__(self, name, shards=DEFAULT_SHARDS):
         '''
         Bank object initialization function
 
         Args:
             name (str) : the name of the bank
+            shards (int, optional) : the number of shard files per entity type, defaults to DEFAULT_SHARDS
         
         Returns:
             Bank Class Object
@@ -86,16 +847,76 @@ class Bank:
         self._name = name
         self._file = file_path/f'{self._name}.json'
         if self._file not in file_path.glob('*.json'):
-            data = {'Bank Name':self._name, 'Customers':[], 'Accounts':[], 'Credit Cards':[], 'Loans':[]}
+            data = {'Bank Name':self._name, 'Shards':shards, 'Entities':ENTITIES, 'Next Id':dict(FIRST_IDS), 'Period':0}
 
+            (file_path/self._name).mkdir(parents=True, exist_ok=True)
             self._file.touch()
             with self._file.open('w') as f:
                 json.dump(data, f)
         else:
             logging.error(ValueError(f'A bank with name {self._name} already exists'))
             raise ValueError(f'A bank with name {self._name} already exists')
+        self._shards = shards
+        self._period = 0
+        self._swept = 0
+        self._cursor = None
+        _PERIODS[self._name] = self._period
+        _RISK_RULES[self._name] = RiskRules()
+        _SHARD_COUNTS.pop(self._name, None)
+        _SNAPSHOT_BASES.pop(self._name, None)
+        _REGISTRIES[self._name] = Registry(self._name)
         logger.info(f'Bank Created with the name {self._name} and database file at {self._file}')
         Bank.__BANKS__.append(self)
+
+    @classmethod
+    def open(cls, name):
+        '''
+        Opens an existing bank. Its customers, accounts and credit cards are loaded from the bank database as they are looked up
+
+        Args:
+            name (str) : the name of the bank
+
+        Returns:
+            Bank Class Object
+        '''
+        for bank in Bank.__BANKS__:
+            if bank._name == name:
+                return bank
+        manifest = json_load(file_path/f'{name}.json')
+        self = cls.__new__(cls)
+        self._name = name
+        self._file = file_path/f'{name}.json'
+        self._shards = manifest['Shards']
+        self._period = manifest.get('Period', 0)
+        self._swept = None
+        self._cursor = None
+        _PERIODS[name] = self._period
+        _RISK_RULES.pop(name, None)
+        _SHARD_COUNTS.pop(name, None)
+        _SNAPSHOT_BASES.pop(name, None)
+        _REGISTRIES[name] = Registry(name)
+        #Opening the event stream redoes a batch a crash left in the outbox, before anything else touches the bank
+        events.stream(file_path/name)
+        logger.info(f'Bank opened with the name {self._name} and database file at {self._file}')
+        Bank.__BANKS__.append(self)
+        return self
+
+    def close(self):
+        '''
+        Unloads all objects associated with this bank object, the bank database is kept and can be reopened with Bank.open.
+        Only this bank's loaded objects are touched.
+        '''
+        bank_registry = _REGISTRIES.pop(self._name, None)
+        if bank_registry is not None:
+            bank_registry.clear()
+        if self in Bank.__BANKS__:
+            Bank.__BANKS__.remove(self)
+        _PERIODS.pop(self._name, None)
+        _RISK_RULES.pop(self._name, None)
+        _SHARD_COUNTS.pop(self._name, None)
+        _SNAPSHOT_BASES.pop(self._name, None)
+        events.close_stream(file_path/self._name)
+        logger.info(f'Bank closed with the name {self._name}')
         
     @property
     def name(self):
@@ -105,37 +926,156 @@ class Bank:
     def file(self):
         '''get file path'''
         f'{self._name} data file is located at {self._file}'
+    @property
+    def shards(self):
+        '''get number of shards each entity type starts with, before it is split'''
+        return self._shards
+    @property
+    def period(self):
+        '''get the number of month ends the bank has gone through'''
+        return self._period
+    @property
+    def risk_rules(self):
+        '''get the credit card risk rules'''
+        return risk_rules(self._name)
+    @risk_rules.setter
+    def risk_rules(self, rules):
+        '''sets the credit card risk rules and stores them in the bank manifest'''
+        _RISK_RULES[self._name] = rules
+        manifest = json_load(self._file)
+        manifest['Risk Rules'] = rules.to_dict()
+        json_write(self._file, manifest)
+        logger.info(f'Bank {self._name} risk rules set to {rules.to_dict()}')
+    @property
+    def events(self):
+        '''get the bank's event stream, consumers read it from their committed offsets'''
+        return events.stream(file_path/self._name)
     
+    def customer(self, customer_id):
+        '''
+        Gets a customer of the bank, loading it from the bank database if it is not loaded
+
+        Args:
+            customer_id (int) : The customer id
+
+        Returns:
+            Customer Class Object
+        '''
+        return self._lookup('Customers', customer_id, f'Customer {customer_id} does not exist at {self._name}')
+
+    def account(self, account_id):
+        '''
+        Gets an account of the bank, loading it from the bank database if it is not loaded
+
+        Args:
+            account_id (int) : The account id
+
+        Returns:
+            SavingsAccount or CheckingAccount Class Object
+        '''
+        return self._lookup('Accounts', account_id, f'Account {account_id} does not exist at {self._name}')
+
+    def card(self, card_number):
+        '''
+        Gets a credit card of the bank, loading it from the bank database if it is not loaded
+
+        Args:
+            card_number (int) : The card number
+
+        Returns:
+            CreditCard Class Object
+        '''
+        return self._lookup('Credit Cards', card_number, f'Credit card {card_number} does not exist at {self._name}')
+
+    def _lookup(self, entity, key, missing):
+        '''Gets an object from the bank's registry, raising a ValueError with {missing} if the bank has no such record'''
+        obj = registry(self._name).get(entity, key)
+        if obj is None:
+            logger.error(ValueError(missing))
+            raise ValueError(missing)
+        return obj
+
+    def evict(self, obj):
+        '''
+        Unloads a customer, account or credit card of the bank. The next lookup loads it again from the bank database,
+        so the evicted object should not be used afterwards.
+
+        Args:
+            obj (obj) : Customer, SavingsAccount, CheckingAccount or CreditCard Class Object
+        '''
+        if isinstance(obj, Customer):
+            registry(self._name).evict('Customers', obj._customer_id)
+        elif isinstance(obj, CreditCard):
+            registry(self._name).evict('Credit Cards', obj._card_number)
+        else:
+            registry(self._name).evict('Accounts', obj._account_id)
+
+    @batched
     def next_month(self):
         '''
-        Applys interest to all savings accounts and credit cards within the bank by calling their own next_month() method
+        Moves the bank to the next month. Only the bank manifest is written, each savings account and credit card
+        applies the month's interest the next time it is read or written, or when the bank is swept
+        '''
+        self._period += 1
+        _PERIODS[self._name] = self._period
+        manifest = json_load(self._file)
+        manifest['Period'] = self._period
+        json_write(self._file, manifest)
+        publish(self._name, 'month_rollover', {'Period':self._period})
+        logger.info(f'Bank {self._name} moved to month {self._period}')
+
+    def sweep(self, limit=None):
         '''
-        for acct in SavingsAccount.__ACCOUNTS__:
-            if acct._bank_name == self._name:
-                acct.next_month()
-        for card in CreditCard.__CARDS__:
-            if card._bank_name == self._name:
-                card.next_month() 
+        Catches up savings accounts and credit cards of this bank that have not accrued the current month yet, loaded or not.
+        Also drops the risk check windows of cards with no recent activity. A sweep stopped by {limit} resumes from the
+        shard and id it stopped at, so sweeping a month end reads each shard once however many calls it takes.
+
+        Args:
+            limit (int, optional) : The most accounts and cards to catch up, defaults to None for all of them
+
+        Returns:
+            int: the number of accounts and cards caught up
+        '''
+        registry(self._name).prune()
+        if self._swept == self._period:
+            return 0
+        swept = 0
+        entities = ['Accounts', 'Credit Cards']
+        #The cursor is the month being swept, then the entity, shard and last id already swept
+        if self._cursor is None or self._cursor[0] != self._period:
+            self._cursor = (self._period, 0, 0, 0)
+        _, entity_index, index, after = self._cursor
+        while entity_index < len(entities):
+            entity = entities[entity_index]
+            #Counted again each shard, a split only moves records to shards after the ones already swept
+            while index < entity_shards(self._name, entity):
+                records = shard_view(self._name, entity, index, entity_shards(self._name, entity))
+                for key in sorted(int(key) for key in records):
+                    if key <= after:
+                        continue
+                    if 'Period' in records[str(key)] and records[str(key)]['Period'] < self._period:
+                        if limit is not None and swept >= limit:
+                            self._cursor = (self._period, entity_index, index, after)
+                            return swept
+                        registry(self._name).get(entity, key)._catch_up()
+                        swept += 1
+                    after = key
+                index, after = index + 1, 0
+            entity_index, index = entity_index + 1, 0
+        self._swept = self._period
+        self._cursor = None
+        return swept
             
                 
-    def __del__(self):
-        '''
-        Deletes all objects associated with this bank object
-        '''
-        for customer in Customer.__CUSTOMERS__:
-            if customer._bank_name == self._name:
-                del customer
-        for account in CheckingAccount.__ACCOUNTS__:
-            if account._bank_name == self._name:
-                del account
-        for account in SavingsAccount.__ACCOUNTS__:
-            if account._bank_name == self._name:
-                del account
-        for card in CreditCard.__CARDS__:
-            if card._bank_name == self._name:
-                del card
-        Bank.__BANKS__.remove(self)
+    def destroy(self):
+        '''
+        Closes the bank and deletes its bank database. Deleting is only ever done here, never when a bank object is
+        garbage collected.
+        '''
+        self.close()
         os.remove(self._file)
+        shutil.rmtree(file_path/self._name, ignore_errors=True)
+        logger.info(f'Bank destroyed with the name {self._name}')
 
 
 class Customer:
@@ -152,7 +1092,8 @@ class Customer:
     Methods:
 
     '''
-    __CUSTOMERS__ = []
+    __CUSTOMERS__ = LoadedObjects('Customers')
+    @batched
     def __init__(self, bank_name, ssn, fname, lname, address):
         '''
         Customer object initialization function
@@ -182,41 +1123,53 @@ class Customer:
         self._lname = lname
         self._address = address
 
-        #Input validation
-        self._file = file_path/f'{self._bank_name}.json'
-        data = json_load(self._file)
-        
         #Creating a new customer in the database if they are not already present
-        existing_ssn = {cust['SSN'] for cust in data['Customers']}
-        cust_ids = {cust['Customer Id'] for cust in data['Customers']}
-        if ssn in existing_ssn:
+        if record_load(self._bank_name, 'SSNs', ssn) is not None:
             logging.error(ValueError(f'A customer already exists with the ssn supplied'))
             raise ValueError(f'A customer already exists with the ssn supplied')
         else:
-            try: 
-                new_id = max(cust_ids)+1
-            except ValueError as e:
-                logging.error(e)
-                new_id = 10001
+            new_id = next_id(self._bank_name, 'Customers')
             self._customer_id = new_id
-            data['Customers'].append({
+            record_update(self._bank_name, 'Customers', new_id, {
                                     'Customer Id':new_id,
                                     'SSN':ssn, 
                                     'First Name':fname, 
                                     'Last Name':lname,
                                     'Address':address
                                     })
-            
-            json_write(self._file, data)
+            #Looked up again as taking the id can split the ssn index
+            ssn_file = record_file(self._bank_name, 'SSNs', ssn)
+            data = shard_load(ssn_file)
+            data[str(ssn)] = new_id
+            json_write(ssn_file, data, [ssn])
+            publish(self._bank_name, 'customer_created', {'Customer Id':new_id, 'First Name':fname, 'Last Name':lname, 'Address':address})
+
             logger.info(f'Customer created at {self._bank_name} for {self._fname} {self._lname} with an customer id of {self._customer_id}')
             print(f'Welcome {self._fname} {self._lname} to {self._bank_name}!! Your customer id is {self._customer_id}')
-            Customer.__CUSTOMERS__.append(self)
+            registry(self._bank_name).add('Customers', self._customer_id, self)
+
+    @classmethod
+    def _from_record(cls, bank_name, record):
+        '''Rebuilds a customer object from its record in the bank database, without writing to it'''
+        self = cls.__new__(cls)
+        self._bank_name = bank_name
+        self._customer_id = record['Customer Id']
+        self._ssn = record['SSN']
+        self._fname = record['First Name']
+        self._lname = record['Last Name']
+        self._address = record['Address']
+        registry(bank_name).add('Customers', self._customer_id, self)
+        return self
 
     @property
     def bank_name(self):
         '''Gets bank name'''
         return self._bank_name
     @property
+    def _file(self):
+        '''Gets the shard file holding the customer record, which moves when the customers are split into more shards'''
+        return record_file(self._bank_name, 'Customers', self._customer_id)
+    @property
     def customer_id(self):
         '''Gets customer id'''
         return self._customer_id
@@ -233,12 +1186,12 @@ class Customer:
         '''Gets last name'''
         return f"Customer's last name: {self._lname}"
     @lname.setter
+    @batched
     def lname(self, new_name):
         '''Sets last name and updates bank database'''
         self._lname = new_name
-        data = json_load(self._file)
-        (cust.update('Last Name', new_name) for cust in data['Customers'] if cust['Customer Id'] == self._customer_id)
-        json_write(self._file, data)
+        record_update(self._bank_name, 'Customers', self._customer_id, {'Last Name':new_name})
+        publish(self._bank_name, 'customer_updated', {'Customer Id':self._customer_id, 'Last Name':new_name})
 
         logger.info(f'Customer with id {self._customer_id} changed their lastname to {self._lname}')
     @property
@@ -246,12 +1199,12 @@ class Customer:
         '''Gets address'''
         return f"Customer's last name: {self._address}"
     @address.setter
+    @batched
     def address(self, new_address):
         '''Sets address and updates bank database'''
         self._address = new_address
-        data = json_load(self._file)
-        (cust.update('Address', new_address) for cust in data['Customers'] if cust['Customer Id'] == self._customer_id)
-        json_write(self._file, data)
+        record_update(self._bank_name, 'Customers', self._customer_id, {'Address':new_address})
+        publish(self._bank_name, 'customer_updated', {'Customer Id':self._customer_id, 'Address':new_address})
         
         logger.info(f'Customer with id {self._customer_id} changed their address to {self._address}')
     
@@ -259,19 +1212,6 @@ class Customer:
     def file(self):
         '''Gets file location'''
         return f'{self._bank_name} data file is located at {self._file}'
-    
-    def __del__(self):
-        '''Deletes customer object and its references from the bank database'''
-        try:
-            Customer.__CUSTOMERS__.remove(self)
-            data = json_load(self._file)
-            (data['Customers'].remove(cust) for cust in data['Customers'] if cust['Customer Id'] == self._customer_id)
-            accounts = [account['Account Id'] for account in data['Accounts'] if account['Customer Id'] == self._customer_id]
-            json_write(self._file, data)
-            print(f'Customer {self._fname} {self._lname} removed from the bank database')
-            print(f'{len(accounts)} Accounts remain open with Account Ids {accounts}') if len(accounts) > 0 else print(f'Customer had no Accounts remaining with {self._bank_name}')
-        except ValueError:
-            pass
         
             
 
@@ -302,30 +1242,41 @@ class Account:
         self._bank_name = bank_name
         self._customer_id = customer_id
         self._balance = starting_balance
+        self._published_balance = starting_balance
 
-        self._file = file_path/f'{self._bank_name}.json'
-        data = json_load(self._file)
-
-        acct_ids = {acct['Account Id'] for acct in data['Accounts']}
-        try: 
-            new_id = max(acct_ids)+1
-        except ValueError:
-            new_id = 90001
+        new_id = next_id(self._bank_name, 'Accounts')
         self._account_id = new_id
 
-        data['Accounts'].append({
+        self._holds = {}
+
+        record_update(self._bank_name, 'Accounts', new_id, {
                                 'Account Id':new_id,
                                 'Customer Id': self._customer_id,
                                 'Balance':starting_balance, 
+                                'Holds':self._holds
                                 })
-        
-        json_write(self._file, data)
+
+    @classmethod
+    def _from_record(cls, bank_name, record):
+        '''Rebuilds an account object from its record in the bank database, without writing to it'''
+        self = cls.__new__(cls)
+        self._bank_name = bank_name
+        self._customer_id = record['Customer Id']
+        self._balance = record['Balance']
+        self._published_balance = self._balance
+        self._holds = record.get('Holds', {})
+        self._account_id = record['Account Id']
+        return self
     
     @property
     def bank_name(self):
         '''Gets bank name'''
         return self._bank_name
     @property
+    def _file(self):
+        '''Gets the shard file holding the account record, which moves when the accounts are split into more shards'''
+        return record_file(self._bank_name, 'Accounts', self._account_id)
+    @property
     def customer_id(self):
         '''Gets customer id'''
         return self._customer_id
@@ -336,15 +1287,14 @@ class Account:
     @property
     def balance(self):
         '''Gets account balance'''
+        self._catch_up()
         return 'Customer {} Balance is: {}${:0,.2f}'.format(self._customer_id,'-' if self._balance < 0 else '', abs(self._balance))
     @balance.setter
     def balance(self, new_balance):
         '''sets account balance and updates the bank database'''
+        self._catch_up()
         self._balance = new_balance
-
-        data = json_load(self._file)
-        (acct.update('Balance', new_balance) for acct in data['Accounts'] if acct['Account Id'] == self._account_id)
-        json_write(self._file, data)
+        self._save('set')
         
         logger.info(f'Account with id {self._account_id} has a new balance of {self._balance}')
     @property
@@ -354,6 +1304,7 @@ class Account:
     
     def __str__(self):
         '''Returns a string representation of the account'''
+        self._catch_up()
         return 'Customer {} Account {} with a balance of {}{:0,.2f}'.format(self._customer_id, self._account_id,'-' if self._balance < 0 else '',abs(self._balance))
     
     def deposit(self, amount):
@@ -366,10 +1317,29 @@ class Account:
         Returns:
             None
         '''
+        self._catch_up()
         logger.info('Customer with id {} has deposited ${:0,.2f}'.format(self._customer_id, amount))
         self._balance += amount
+        self._save('deposit')
         print(self)
 
+    @batched
+    def _save(self, reason=None):
+        '''Writes the account balance and transfer holds to the shard holding the account'''
+        record_update(self._bank_name, 'Accounts', self._account_id, {'Balance':self._balance, 'Holds':self._holds})
+        self._publish_balance(reason)
+
+    def _publish_balance(self, reason):
+        '''Publishes a balance_changed event if the balance moved since the last one, {reason} is what moved it'''
+        if self._balance != self._published_balance:
+            publish(self._bank_name, 'balance_changed', {'Account Id':self._account_id, 'Balance':self._balance,
+                                                         'Change':self._balance - self._published_balance, 'Reason':reason})
+            self._published_balance = self._balance
+
+    def _catch_up(self):
+        '''Accounts without interest have nothing to catch up on'''
+        pass
+
         
 
 
@@ -389,8 +1359,9 @@ class SavingsAccount(Account):
     Methods:
 
     '''
-    __ACCOUNTS__ = []
+    __ACCOUNTS__ = LoadedObjects('Accounts', 'S')
 
+    @batched
     def __init__(self, bank_name, customer_id, starting_balance=500, minimum_balance=500, interest_rate=0.005):
         '''
         SavingsAccount object initialization function
@@ -407,18 +1378,29 @@ class SavingsAccount(Account):
         self._minimum_balance = minimum_balance
         self._interest_rate = interest_rate
         self._type = 'S'
+        self._period = bank_period(self._bank_name)
 
-        data = json_load(self._file)
-        for acct in data['Accounts']:
-            if acct['Account Id'] == self._account_id:
-                acct['Type']=self._type
-                acct['Minimum Balance'] = self._minimum_balance
-                acct['Interest Rate'] = self._interest_rate
-        
-        json_write(self._file, data)
+        record_update(self._bank_name, 'Accounts', self._account_id, {
+                                'Type':self._type,
+                                'Minimum Balance':self._minimum_balance,
+                                'Interest Rate':self._interest_rate,
+                                'Period':self._period
+                                })
+        publish(self._bank_name, 'account_opened', {'Account Id':self._account_id, 'Customer Id':self._customer_id, 'Type':self._type, 'Balance':self._balance})
         print(f'Savings Account created at {self._bank_name} with id {self._account_id} for customer with id {self._customer_id}')
         logger.info(f'Savings Account created at {self._bank_name} with id {self._account_id} for customer with id {self._customer_id}')
-        SavingsAccount.__ACCOUNTS__.append(self)
+        registry(self._bank_name).add('Accounts', self._account_id, self)
+
+    @classmethod
+    def _from_record(cls, bank_name, record):
+        '''Rebuilds a savings account object from its record in the bank database, without writing to it'''
+        self = super()._from_record(bank_name, record)
+        self._minimum_balance = record['Minimum Balance']
+        self._interest_rate = record['Interest Rate']
+        self._type = 'S'
+        self._period = record.get('Period', bank_period(bank_name))
+        registry(bank_name).add('Accounts', self._account_id, self)
+        return self
     
     @property
     def minimum_balance(self):
@@ -444,20 +1426,38 @@ class SavingsAccount(Account):
             amount (float): The amount to be withdrawn from the account
 
         '''
+        self._catch_up()
         if self._minimum_balance <= self._balance - amount:
             logger.info('Customer with id {} has withdrawn ${:0,.2f}'.format(self._customer_id, amount))
             self._balance -= amount
         else:
             raise ValueError('The account {} cannot withstand a withdrawl of ${:0,.2f}'.format(self._account_id, amount))
+        self._save('withdrawal')
         print(self)
 
     def next_month(self):
-        '''Applys interest to the savings account'''
+        '''Applys a month of interest to the savings account'''
+        self._accrue()
+        self._save('interest')
+
+    def _accrue(self):
+        '''Applys a month of interest to the balance'''
         self._balance += self._balance*(self._interest_rate/12)
-    
-    def __del__(self):
-        '''Removes account from the list of savings accounts objects'''
-        SavingsAccount.__ACCOUNTS__.remove(self)
+
+    def _catch_up(self):
+        '''Applys the interest of every month the bank has moved through since the account last accrued'''
+        period = bank_period(self._bank_name)
+        if self._period < period:
+            while self._period < period:
+                self._accrue()
+                self._period += 1
+            self._save('interest')
+
+    @batched
+    def _save(self, reason=None):
+        '''Writes the account balance, transfer holds and last accrued month to the shard holding the account'''
+        record_update(self._bank_name, 'Accounts', self._account_id, {'Balance':self._balance, 'Holds':self._holds, 'Period':self._period})
+        self._publish_balance(reason)
 
 
 class CheckingAccount(Account):
@@ -473,7 +1473,8 @@ class CheckingAccount(Account):
     Methods:
 
     '''
-    __ACCOUNTS__ = []
+    __ACCOUNTS__ = LoadedObjects('Accounts', 'C')
+    @batched
     def __init__(self, bank_name, customer_id, starting_balance=0):
         '''
         CheckingAccount object initialization function
@@ -491,16 +1492,24 @@ class CheckingAccount(Account):
         self._overdraft_fee = 25
         self._type = 'C'
 
-        data = json_load(self._file)
-        for acct in data['Accounts']:
-            if acct['Account Id'] == self._account_id:
-                acct['Type'] = self._type
-                acct['Overdraft Limit'] = self._overdraft_limit
-                acct['Overdraft Fee'] = self._overdraft_fee
-        
-        json_write(self._file, data)
+        record_update(self._bank_name, 'Accounts', self._account_id, {
+                                'Type':self._type,
+                                'Overdraft Limit':self._overdraft_limit,
+                                'Overdraft Fee':self._overdraft_fee
+                                })
+        publish(self._bank_name, 'account_opened', {'Account Id':self._account_id, 'Customer Id':self._customer_id, 'Type':self._type, 'Balance':self._balance})
         print(f'Checking Account created at {self._bank_name} with id {self._account_id} for customer with id {self._customer_id}')
-        CheckingAccount.__ACCOUNTS__.append(self)
+        registry(self._bank_name).add('Accounts', self._account_id, self)
+
+    @classmethod
+    def _from_record(cls, bank_name, record):
+        '''Rebuilds a checking account object from its record in the bank database, without writing to it'''
+        self = super()._from_record(bank_name, record)
+        self._overdraft_limit = record['Overdraft Limit']
+        self._overdraft_fee = record['Overdraft Fee']
+        self._type = 'C'
+        registry(bank_name).add('Accounts', self._account_id, self)
+        return self
     
     @property
     def overdraft_limit(self):
@@ -517,12 +1526,13 @@ class CheckingAccount(Account):
         '''Gets account type'''
         return 'Checking Account'
     
-    def withdraw(self, amount):
+    def withdraw(self, amount, confirm=None):
         '''
         Withdraws the amount specified, and if the user will incurr an overdraft fee, then asks for the users confirmation
 
         Args:
             amount (float): The amount to be withdrawn from the account
+            confirm (bool, optional): Answer to the overdraft fee confirmation, defaults to None which asks the user
 
         Returns:
             str: The remaining balance of the account
@@ -535,7 +1545,10 @@ class CheckingAccount(Account):
             logger.error(ValueError('The requested withdrawl brings the account balance below the overdraft limit'))
             raise ValueError('The requested withdrawl brings the account balance below the overdraft limit')
         else:
-            confirm = input(f'The requested withdrawl will incurr an overdraft fee of {self._overdraft_fee}. Would you like to continue (y/n)')
+            if confirm is None:
+                confirm = input(f'The requested withdrawl will incurr an overdraft fee of {self._overdraft_fee}. Would you like to continue (y/n)')
+            else:
+                confirm = 'y' if confirm else 'n'
             if confirm.lower() == 'y':
                 logger.info('Customer with id {} has withdrawn ${:0,.2f} and incurred a overdraft fee of {}'.format(self._customer_id, amount, self._overdraft_fee))
                 self._balance -= (amount + self._overdraft_fee)
@@ -543,12 +1556,9 @@ class CheckingAccount(Account):
                 print('Withdrawl Canceled')
             else:
                 raise ValueError('Input must be either a "y" or "n"')
+        self._save('withdrawal')
         print(self)
     
-    def __del__(self):
-        '''Removes account from the list of checkings accounts objects'''
-        CheckingAccount.__ACCOUNTS__.remove(self)
-    
                 
 class CreditCard():
     '''
@@ -566,7 +1576,8 @@ class CreditCard():
         Spend : Makes a purchase on the card
         Pay : Pays off the account
     '''
-    __CARDS__ = []
+    __CARDS__ = LoadedObjects('Credit Cards')
+    @batched
     def __init__(self, bank_name, customer_id, limit=1000):
         '''
         CreditCard object initialization function
@@ -585,41 +1596,56 @@ class CreditCard():
         self._apr = 0.26
         self._statement_balance = 0
         self._current_balance = 0
+        self._period = bank_period(self._bank_name)
 
-
-        self._file = file_path/f'{self._bank_name}.json'
-        data = json_load(self._file)
-
-        cards = {card['Card Number'] for card in data['Credit Cards']}
-        
-        try: 
-            new_card = max(cards)+1
-        except ValueError:
-            new_card = 1234123412340001
+        new_card = next_id(self._bank_name, 'Credit Cards')
 
         self._card_number = new_card
+        self._velocity = registry(self._bank_name).velocity(new_card)
         self._cvv = randint(100,999)
 
-        data['Credit Cards'].append({
+        record_update(self._bank_name, 'Credit Cards', self._card_number, {
             'Customer Id': self._customer_id,
             'Card Number': self._card_number,
             'CVV': self._cvv,
             'Credit Limit': self._limit,
             'APR': self._apr,
             'Statement Balance': self._statement_balance,
-            'Current Balance': self._current_balance
+            'Current Balance': self._current_balance,
+            'Period': self._period
         })
 
-        json_write(self._file, data)
+        publish(self._bank_name, 'card_opened', {'Card Number':self._card_number, 'Customer Id':self._customer_id, 'Credit Limit':self._limit})
         logger.info(f'Credit Card opened with credit card number {self._card_number}')
         print(f'Credit Card created at {self._bank_name} with card number {self._card_number} for customer with id {self._customer_id}')
-        CreditCard.__CARDS__.append(self)
+        registry(self._bank_name).add('Credit Cards', self._card_number, self)
+
+    @classmethod
+    def _from_record(cls, bank_name, record):
+        '''Rebuilds a credit card object from its record in the bank database, without writing to it'''
+        self = cls.__new__(cls)
+        self._bank_name = bank_name
+        self._customer_id = record['Customer Id']
+        self._card_number = record['Card Number']
+        self._cvv = record['CVV']
+        self._limit = record['Credit Limit']
+        self._apr = record['APR']
+        self._statement_balance = record['Statement Balance']
+        self._current_balance = record['Current Balance']
+        self._period = record.get('Period', bank_period(bank_name))
+        self._velocity = registry(bank_name).velocity(self._card_number)
+        registry(bank_name).add('Credit Cards', self._card_number, self)
+        return self
 
     @property
     def bank_name(self):
         '''Gets bank name'''
         return self._bank_name
     @property
+    def _file(self):
+        '''Gets the shard file holding the card record, which moves when the cards are split into more shards'''
+        return record_file(self._bank_name, 'Credit Cards', self._card_number)
+    @property
     def customer_id(self):
         '''Gets customer name'''
         return self._customer_id
@@ -642,12 +1668,15 @@ class CreditCard():
     @property
     def statement_balance(self):
         '''Gets formatted statment balance'''
+        self._catch_up()
         return '${:0,.2f}'.format(self._statement_balance)
     @property
     def current_balance(self):
         '''Gets formatted current balance'''
+        self._catch_up()
         return '${:0,.2f}'.format(self._current_balance)
     
+    @batched
     def spend(self, amount, cvv, note=None):
         '''
         Makes a purchase with the card of {amount}
@@ -658,23 +1687,51 @@ class CreditCard():
             note (str, optional) : A note for the purchase, defaults to None
         
         '''
-        if cvv != self._cvv:
-            logger.error(ValueError('Transaction declined for ${:0,.2f} on card {}'.format(amount, self._card_number)))
-            raise ValueError('The CVV supplied does not match, transaction declined')
-        else:
-            pass
-        if self._limit < self._current_balance + amount:
-            logger.error(ValueError('Transaction declined for ${:0,.2f} on card {}'.format(amount, self._card_number)))
-            raise ValueError('The purchase was declined. It would put your card over its limit, you can spend ${:0,.2f} more before maxing out'.format((self._limit-self._current_balance)))
+        self._catch_up()
+        self._authorize(amount, cvv)
         self._current_balance += amount
         self._statement_balance += amount
-        
-        data = json_load(self._file)
-        (card.update({'Current Balance': self._current_balance, 'Statement Balance':self._statement_balance}) for card in data['Credit Cards'] if card['Card Number']==self._card_number)
-        json_write(self._file, data)
+        self._save()
+        publish(self._bank_name, 'card_spend', {'Card Number':self._card_number, 'Amount':amount, 'Note':note,
+                                                'Current Balance':self._current_balance, 'Statement Balance':self._statement_balance})
         logger.info('Purchase made with note:{} on card {} for ${:0,.2f}'.format(note, self._card_number, amount)) if note is not None else logger.info('Purchase made on card {} for ${:0,.2f}'.format( self._card_number, amount))
 
 
+    def _authorize(self, amount, cvv):
+        '''
+        Checks a purchase against the CVV, the bank's risk rules and the credit limit, recording the decision.
+        Raises a ValueError if the purchase is declined.
+
+        Args:
+            amount (float) : Dollar amount to be spent
+            cvv (int) : Three digit security code
+        '''
+        rules = risk_rules(self._bank_name)
+        now = time.monotonic()
+        velocity = self._velocity
+        if rules.cvv_failures is not None and velocity['CVV Failures'].total(now) >= rules.cvv_failures:
+            reason = 'The card is locked after repeated CVV failures, transaction declined'
+        elif cvv != self._cvv:
+            velocity['CVV Failures'].add(now)
+            reason = 'The CVV supplied does not match, transaction declined'
+        elif rules.purchases_per_minute is not None and velocity['Purchases'].total(now) >= rules.purchases_per_minute:
+            reason = 'The purchase was declined. The card has made too many purchases in the last minute'
+        elif rules.amount_per_hour is not None and velocity['Amount'].total(now) + amount > rules.amount_per_hour:
+            reason = 'The purchase was declined. The card has spent too much in the last hour'
+        elif self._limit < self._current_balance + amount:
+            reason = 'The purchase was declined. It would put your card over its limit, you can spend ${:0,.2f} more before maxing out'.format((self._limit-self._current_balance))
+        else:
+            reason = None
+            velocity['Purchases'].add(now)
+            velocity['Amount'].add(now, amount)
+
+        risk_logger.info(json.dumps({'Bank Name':self._bank_name, 'Card Number':self._card_number, 'Amount':amount,
+                                     'Decision':'Approved' if reason is None else 'Declined', 'Reason':reason}))
+        if reason is not None:
+            logger.error(ValueError('Transaction declined for ${:0,.2f} on card {}'.format(amount, self._card_number)))
+            raise ValueError(reason)
+
+    @batched
     def pay(self, account_id, amount):
         '''
         Pays off credit card using funds from account at {account_id}
@@ -683,7 +1740,11 @@ class CreditCard():
             account_id (int) : Account id of a checking account
             amount (fload) : Dollar amount to pay off
         '''
-        account = next(acct for acct in CheckingAccount.__ACCOUNTS__ if acct._account_id == account_id)
+        self._catch_up()
+        account = registry(self._bank_name).get('Accounts', account_id)
+        if not isinstance(account, CheckingAccount):
+            logger.error(ValueError(f'Account {account_id} is not a checking account at {self._bank_name}'))
+            raise ValueError(f'Account {account_id} is not a checking account at {self._bank_name}')
         last_month = self._current_balance - self._statement_balance
         if account._balance < amount:
             logger.error(ValueError('The account id specified only has ${:0,.2f} available, and cannot pay ${:0,.2f}'.format(account._balance, amount)))
@@ -703,36 +1764,48 @@ class CreditCard():
             account.withdraw(amount)
             print('${:0,.2f} was paid towards credit card {} with funds from account id {}. The remaining statement balance is ${:0,.2f} and total balance is ${:0,.2f}'.format(amount, self._card_number, account_id, self._statement_balance, self._statement_balance))
 
-        data = json_load(self._file)
-        
-        (card.update({
-            'Current Balance': self._current_balance,
-            'Statement Balance': self._statement_balance
-        }) for card in data['Credit Cards'] if card['Card Number'] == self._card_number)
-
-        json_write(self._file, data)
+        self._save()
+        publish(self._bank_name, 'card_payment', {'Card Number':self._card_number, 'Account Id':account_id, 'Amount':amount,
+                                                  'Current Balance':self._current_balance, 'Statement Balance':self._statement_balance})
 
+    @batched
     def next_month(self):
         '''
         Iterates to the next month, applying interest and moving to the next statement
         '''
-        if self.current_balance == self.statement_balance:
+        self._accrue()
+        self._save()
+        self._publish_statement()
+
+    def _accrue(self):
+        '''Applys a month of interest and moves to the next statement'''
+        if '${:0,.2f}'.format(self._current_balance) == '${:0,.2f}'.format(self._statement_balance):
                 self._current_balance = self._statement_balance
                 self._statement_balance = 0
         else:
             self._current_balance = self._statement_balance + ((self._current_balance-self._statement_balance)*(1+self._apr/12))
             self._statement_balance = 0
-            
 
-        data = json_load(self._file)
-        (card.update({
+    @batched
+    def _catch_up(self):
+        '''Applys every month the bank has moved through since the card last accrued'''
+        period = bank_period(self._bank_name)
+        if self._period < period:
+            while self._period < period:
+                self._accrue()
+                self._period += 1
+            self._save()
+            self._publish_statement()
+
+    def _publish_statement(self):
+        '''Publishes a card_statement event with the balances after a month end'''
+        publish(self._bank_name, 'card_statement', {'Card Number':self._card_number, 'Period':self._period,
+                                                    'Current Balance':self._current_balance, 'Statement Balance':self._statement_balance})
+
+    def _save(self):
+        '''Writes the card balances and last accrued month to the shard holding the card'''
+        record_update(self._bank_name, 'Credit Cards', self._card_number, {
             'Current Balance': self._current_balance,
-            'Statement Balance': self._statement_balance
-        }) for card in data['Credit Cards'] if card['Card Number'] == self._card_number)
-
-        json_write(self._file, data)
-    
-    def __del__(self):
-        '''Removes the credit card from the list of credit card objects'''
-        CreditCard.__CARDS__.remove(self)
-        
+            'Statement Balance': self._statement_balance,
+            'Period': self._period
+        })
@@ -0,0 +1,360 @@
+'''
+Change data capture for bank mutations
+
+Every change the banking module makes is published as an event. Events are a dict:
+
+    {"Seq": 42, "Time": "2024-01-01T12:00:00", "Bank Name": "First Bank", "Type": "balance_changed", "Data": {...}}
+
+Event types are customer_created, customer_updated, account_opened, balance_changed, card_opened, card_spend,
+card_payment, card_statement and month_rollover. Each event goes to the in process subscribers and is appended to the
+bank's durable stream ({bank}/events.log, one json object per line). Consumers read the stream from their committed
+offset instead of diffing whole bank files.
+
+Changes made inside banking.batch() go through the bank's outbox ({bank}/outbox.json). Before any file of the batch is
+written, its events are numbered and written to the outbox with the records the batch changes, and the outbox is
+forced to disk. Once the files are written the events are appended to the stream, the stream is forced to disk and the
+outbox is removed. A batch is committed once its outbox is on disk: one that fails to write its files is redone from the
+outbox straight away, and an outbox left behind by a crash is redone in full when the stream is next opened, so a
+change and its events are never kept one without the other.
+'''
+import os
+import json
+import logging
+from datetime import datetime
+
+
+#Shares the banking module's log
+logger = logging.getLogger('banking.banking')
+
+_SUBSCRIBERS = []
+_STREAMS = {}
+
+
+def subscribe(callback, types=None):
+    '''
+    Calls {callback} with every event published in this process
+
+    Args:
+        callback (function) : called with the event dict
+        types (list, optional) : event types to receive, defaults to None for all of them
+    '''
+    _SUBSCRIBERS.append((callback, None if types is None else set(types)))
+
+def unsubscribe(callback):
+    '''
+    Stops calling {callback} with events
+
+    Args:
+        callback (function) : a callback passed to subscribe
+    '''
+    _SUBSCRIBERS[:] = [(fn, types) for fn, types in _SUBSCRIBERS if fn is not callback]
+
+def stream(directory):
+    '''
+    Gets the event stream kept in {directory}, opening it on first use
+
+    Args:
+        directory (obj) : pathlib Path object of the bank's shard directory
+
+    Returns:
+        EventStream Class Object
+    '''
+    if directory not in _STREAMS:
+        _STREAMS[directory] = EventStream(directory)
+    return _STREAMS[directory]
+
+def close_stream(directory):
+    '''
+    Closes the event stream kept in {directory} if it is open
+
+    Args:
+        directory (obj) : pathlib Path object of the bank's shard directory
+    '''
+    event_stream = _STREAMS.pop(directory, None)
+    if event_stream is not None:
+        event_stream.close()
+
+def change(bank_name, event_type, data):
+    '''
+    Builds an event, without the sequence number it is given when it is appended to the stream
+
+    Args:
+        bank_name (str) : The name of the bank
+        event_type (str) : The event type
+        data (dict) : The event data
+
+    Returns:
+        dict: the event
+    '''
+    return {'Time':datetime.now().isoformat(timespec='microseconds'), 'Bank Name':bank_name, 'Type':event_type, 'Data':data}
+
+def notify(event):
+    '''
+    Hands an event to the subscribers of its type
+
+    Args:
+        event (dict) : The event
+    '''
+    for callback, types in list(_SUBSCRIBERS):
+        if types is None or event['Type'] in types:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(e)
+
+def publish(directory, bank_name, event_type, data):
+    '''
+    Appends an event to the bank's stream and hands it to the subscribers
+
+    Args:
+        directory (obj) : pathlib Path object of the bank's shard directory
+        bank_name (str) : The name of the bank
+        event_type (str) : The event type
+        data (dict) : The event data
+
+    Returns:
+        dict: the event
+    '''
+    event = stream(directory).append(change(bank_name, event_type, data))
+    notify(event)
+    return event
+
+def _write(file, data):
+    '''Writes {data} as json beside {file}, forces it to disk and moves it into place'''
+    temp = file.with_name(file.name + '.tmp')
+    with temp.open('w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, file)
+
+
+class EventStream:
+    '''
+    Append only stream of a bank's events with committed offsets for each consumer
+
+    Attributes:
+        directory (obj) : pathlib Path object of the bank's shard directory
+
+    Methods:
+        append : appends an event and gives it the next sequence number
+        stage : numbers a batch's events and writes them to the outbox with the records the batch writes
+        release : appends the staged events to the stream and clears the outbox
+        discard : drops the staged events and clears the outbox
+        redo : writes the records in the outbox again and appends the events the stream is missing
+        read : reads a consumer's next events after its committed offset
+        commit : commits a consumer's offset up to the last event it read
+        offset : gets the sequence number a consumer has committed up to
+    '''
+    def __init__(self, directory):
+        '''
+        EventStream object initialization function, a partly written last event left by a crash is dropped and an
+        outbox left by a crash is redone
+
+        Args:
+            directory (obj) : pathlib Path object of the bank's shard directory
+        '''
+        self._directory = directory
+        self._file = directory/'events.log'
+        self._offsets_file = directory/'offsets.json'
+        self._outbox_file = directory/'outbox.json'
+        self._reads = {}
+        self._staged = []
+        self._out = self._file.open('a')
+        self._seq = self._last_seq()
+        self.redo()
+
+    def append(self, event):
+        '''
+        Appends {event} to the stream, giving it the next sequence number
+
+        Args:
+            event (dict) : The event without a sequence number
+
+        Returns:
+            dict: the event with its 'Seq'
+        '''
+        if self._staged:
+            self.redo()
+        self._seq += 1
+        event = {'Seq':self._seq, **event}
+        self._out.write(json.dumps(event) + '\n')
+        self._sync()
+        return event
+
+    def stage(self, events, changes):
+        '''
+        Numbers a batch's events and writes them to the outbox along with the records the batch is about to write,
+        forcing the outbox to disk. The batch writes its files after this and then calls release, or redo if writing
+        them fails.
+
+        Args:
+            events (list) : The events without sequence numbers
+            changes (list) : The change to each file, a dict of its 'File' (pathlib Path object) and either the
+                             'Records' changed, keyed by id, or the whole file 'Data'
+
+        Returns:
+            list: the events with their 'Seq'
+        '''
+        #A batch this stream could not finish is redone before the next one is staged
+        if self._staged:
+            self.redo()
+        staged = [{'Seq':self._seq + number, **event} for number, event in enumerate(events, 1)]
+        root = self._directory.parent
+        changes = [dict(change, File=str(change['File'].relative_to(root))) for change in changes]
+        _write(self._outbox_file, {'Events':staged, 'Changes':changes})
+        self._staged = staged
+        return staged
+
+    def release(self):
+        '''
+        Appends the staged events to the stream, forces the stream to disk and clears the outbox
+
+        Returns:
+            list: the events appended
+        '''
+        for event in self._staged:
+            self._out.write(json.dumps(event) + '\n')
+        self._sync()
+        return self._clear()
+
+    def discard(self):
+        '''Drops the staged events and clears the outbox, only for a batch that has not written any of its files'''
+        self._outbox_file.unlink(missing_ok=True)
+        self._staged = []
+
+    def redo(self):
+        '''
+        Redoes the batch left in the outbox, writing its records again and appending the events the stream is missing
+
+        Returns:
+            list: the events appended
+        '''
+        if not self._outbox_file.exists():
+            return []
+        with self._outbox_file.open('r') as f:
+            outbox = json.load(f)
+        root = self._directory.parent
+        for change in outbox['Changes']:
+            file = root/change['File']
+            if 'Data' in change:
+                _write(file, change['Data'])
+                continue
+            data = {}
+            if file.exists():
+                with file.open('r') as f:
+                    data = json.load(f)
+            for key, record in change['Records'].items():
+                if record is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = record
+            _write(file, data)
+        #Events a failed release got as far as writing are not appended twice
+        self._out.flush()
+        self._seq = self._last_seq()
+        self._staged = [event for event in outbox['Events'] if event['Seq'] > self._seq]
+        appended = self.release()
+        logger.info(f'Event outbox of {self._directory.name} redone with {len(appended)} events appended')
+        return appended
+
+    def _clear(self):
+        '''Moves the stream past the staged events, clears the outbox and gives back the events'''
+        staged, self._staged = self._staged, []
+        if staged:
+            self._seq = staged[-1]['Seq']
+        self._outbox_file.unlink(missing_ok=True)
+        return staged
+
+    def _last_seq(self):
+        '''Reads the sequence number of the last whole event in the stream, dropping a partly written one after it'''
+        with self._file.open('rb+') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            f.seek(max(0, end - 65536))
+            tail = f.read()
+            last = tail.rfind(b'\n')
+            if last + 1 < len(tail):
+                f.truncate(end - len(tail) + last + 1)
+            lines = tail[:last].split(b'\n')
+            if last > 0 and lines[-1]:
+                return json.loads(lines[-1])['Seq']
+        return 0
+
+    def _sync(self):
+        '''Forces the appended events to disk'''
+        self._out.flush()
+        os.fsync(self._out.fileno())
+
+    def offset(self, consumer):
+        '''
+        Gets the sequence number {consumer} has committed up to, 0 if it has not committed
+
+        Args:
+            consumer (str) : The consumer name
+
+        Returns:
+            int: the last committed sequence number
+        '''
+        return self._offsets().get(consumer, {}).get('Seq', 0)
+
+    def read(self, consumer, limit=1000):
+        '''
+        Reads the events after {consumer}'s committed offset, or after its last read if it has not committed since
+
+        Args:
+            consumer (str) : The consumer name
+            limit (int, optional) : The most events returned, defaults to 1000
+
+        Returns:
+            list: the events in sequence order
+        '''
+        seq, position = self._reads.get(consumer) or self._committed(consumer)
+        events = []
+        if not self._file.exists():
+            return events
+        with self._file.open('rb') as f:
+            f.seek(position)
+            while len(events) < limit:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                position += len(line)
+                events.append(json.loads(line))
+        if events:
+            seq = events[-1]['Seq']
+        self._reads[consumer] = (seq, position)
+        return events
+
+    def commit(self, consumer):
+        '''
+        Commits {consumer}'s offset up to the last event returned to it by read
+
+        Args:
+            consumer (str) : The consumer name
+        '''
+        if consumer not in self._reads:
+            return
+        seq, position = self._reads.pop(consumer)
+        offsets = self._offsets()
+        offsets[consumer] = {'Seq':seq, 'Position':position}
+        temp = self._offsets_file.with_name(self._offsets_file.name + '.tmp')
+        with temp.open('w') as f:
+            json.dump(offsets, f)
+        os.replace(temp, self._offsets_file)
+
+    def _committed(self, consumer):
+        '''Gets the committed sequence number and byte position of {consumer}'''
+        committed = self._offsets().get(consumer, {'Seq':0, 'Position':0})
+        return committed['Seq'], committed['Position']
+
+    def _offsets(self):
+        '''Loads the committed offsets of every consumer'''
+        if not self._offsets_file.exists():
+            return {}
+        with self._offsets_file.open('r') as f:
+            return json.load(f)
+
+    def close(self):
+        '''Closes the stream file'''
+        self._out.close()
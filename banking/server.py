@@ -0,0 +1,394 @@
+'''
+Local banking service
+
+A long running process that owns the Bank objects in memory and serves them over a Unix socket or localhost TCP.
+Requests and replies are single lines of json:
+
+    request : {"op": "deposit", "args": {"bank": "First Bank", "account_id": 90001, "amount": 50}}
+    reply   : {"ok": true, "result": 1050} or {"ok": false, "error": "..."}
+
+Operations from every connection are queued and applied by one committer thread. It drains up to {batch_size}
+operations, waiting at most {batch_window} seconds for more, applies them in order inside banking.batch() so every
+shard they touch is written once, and only then replies to each caller. A batch is committed once its outbox is on
+disk, so each caller gets its operation's own reply even if a write then fails and is redone from the outbox. Only a
+batch that fails before that is reported as not committed, and nothing of it is written, so the caller can retry it. When no operations arrive for {sweep_interval}
+seconds it sweeps up to {sweep_size} accounts that have not accrued the latest month yet.
+
+Usage:
+    python -m banking.server --socket /tmp/banking.sock
+    python -m banking.server --port 8765
+'''
+import os
+import json
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+
+from banking.banking import logger, batch, Bank, Customer, SavingsAccount, CheckingAccount, CreditCard
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    '''Reads requests from one connection, hands them to the committer thread and writes back the replies'''
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                op, args = request['op'], request.get('args', {})
+            except (ValueError, KeyError, TypeError):
+                reply = {'ok':False, 'error':'Request must be a json object with an "op" field'}
+            else:
+                reply = self.server.bank_server.submit(op, args)
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class BankServer:
+    '''
+    Serves the banks in this process to local clients, batching incoming operations into single commits
+
+    Attributes:
+        address (str or tuple) : Unix socket path, or (host, port) for localhost TCP
+        batch_size (int, optional) : The most operations applied in one commit, defaults to 256
+        batch_window (float, optional) : Seconds to wait for more operations before committing, defaults to 0.002
+        sweep_interval (float, optional) : Seconds without operations before sweeping accounts, defaults to 0.5
+        sweep_size (int, optional) : The most accounts caught up per sweep, defaults to 256
+
+    Methods:
+        start : starts serving in background threads
+        stop : stops serving and closes the banks
+        serve_forever : serves until interrupted
+        submit : queues an operation and waits for its reply
+    '''
+    def __init__(self, address, batch_size=256, batch_window=0.002, sweep_interval=0.5, sweep_size=256):
+        '''
+        BankServer object initialization function
+
+        Args:
+            address (str or tuple) : Unix socket path, or (host, port) for localhost TCP
+            batch_size (int, optional) : The most operations applied in one commit, defaults to 256
+            batch_window (float, optional) : Seconds to wait for more operations before committing, defaults to 0.002
+            sweep_interval (float, optional) : Seconds without operations before sweeping accounts, defaults to 0.5
+            sweep_size (int, optional) : The most accounts caught up per sweep, defaults to 256
+        '''
+        self._batch_size = batch_size
+        self._batch_window = batch_window
+        self._sweep_interval = sweep_interval
+        self._sweep_size = sweep_size
+        self._queue = queue.Queue()
+        self._banks = {}
+        self._server = _UnixServer(address, _Handler) if isinstance(address, str) else _TCPServer(tuple(address), _Handler)
+        self._server.bank_server = self
+        self._threads = []
+
+    @property
+    def address(self):
+        '''Gets the address the server is listening on'''
+        return self._server.server_address
+
+    def start(self):
+        '''Starts the listener and committer threads'''
+        self._threads = [threading.Thread(target=self._server.serve_forever, daemon=True),
+                         threading.Thread(target=self._commit_loop, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f'Banking server listening on {self.address}')
+
+    def stop(self):
+        '''Stops serving, commits the queued operations and closes the banks without deleting them'''
+        self._server.shutdown()
+        self._server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+        self._queue.put(None)
+        self._threads[1].join()
+        self._unload()
+        logger.info(f'Banking server on {self.address} stopped')
+
+    def serve_forever(self):
+        '''Serves until interrupted'''
+        self.start()
+        try:
+            self._threads[0].join()
+        except KeyboardInterrupt:
+            self.stop()
+
+    def submit(self, op, args):
+        '''
+        Queues an operation for the next commit and waits for it to be applied
+
+        Args:
+            op (str) : the operation name
+            args (dict) : the operation arguments
+
+        Returns:
+            dict: the reply sent back to the client
+        '''
+        done = threading.Event()
+        item = {'op':op, 'args':args, 'done':done}
+        self._queue.put(item)
+        done.wait()
+        return item['reply']
+
+    def _commit_loop(self):
+        '''Drains the queue into batches, applies each batch as one commit and then replies to its callers'''
+        while True:
+            try:
+                item = self._queue.get(timeout=self._sweep_interval)
+            except queue.Empty:
+                self._sweep()
+                continue
+            if item is None:
+                return
+            items = [item]
+            while len(items) < self._batch_size:
+                try:
+                    item = self._queue.get(timeout=self._batch_window)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                items.append(item)
+            try:
+                with batch():
+                    for item in items:
+                        item['reply'] = self._apply(item['op'], item['args'])
+            except Exception as e:
+                #batch() only raises before the batch is staged, so none of it is on disk
+                logger.error(e)
+                for item in items:
+                    item['reply'] = {'ok':False, 'error':f'The operation could not be committed, nothing was written: {e}'}
+                self._unload()
+            finally:
+                for item in items:
+                    item['done'].set()
+
+    def _sweep(self):
+        '''Catches up to {sweep_size} idle accounts and cards as one commit, runs only while no operations are waiting'''
+        remaining = self._sweep_size
+        try:
+            with batch():
+                for bank in list(self._banks.values()):
+                    remaining -= bank.sweep(remaining)
+                    if remaining <= 0:
+                        return
+        except Exception as e:
+            logger.error(e)
+            self._unload()
+
+    def _unload(self):
+        '''Closes the banks after a failed commit, so objects changed in memory are read again from the bank database'''
+        for bank in self._banks.values():
+            bank.close()
+        self._banks = {}
+
+    def _apply(self, op, args):
+        '''Applies one operation, turning any error into a failed reply'''
+        method = getattr(self, f'_op_{op}', None)
+        if method is None:
+            return {'ok':False, 'error':f'Unknown operation {op}'}
+        try:
+            return {'ok':True, 'result':method(**args)}
+        except Exception as e:
+            logger.error(e)
+            return {'ok':False, 'error':str(e) or type(e).__name__}
+
+    def _bank(self, bank):
+        '''Gets a bank owned by the server, opening it from the bank database on first use'''
+        if bank not in self._banks:
+            self._banks[bank] = Bank.open(bank)
+        return self._banks[bank]
+
+    def _account(self, bank, account_id):
+        '''Gets an account object of the bank'''
+        return self._bank(bank).account(account_id)
+
+    def _card(self, bank, card_number):
+        '''Gets a credit card object of the bank'''
+        return self._bank(bank).card(card_number)
+
+    def _op_create(self, kind, bank, **args):
+        '''Creates a bank, customer, savings account, checking account or credit card and returns its id'''
+        if kind == 'bank':
+            self._banks[bank] = Bank(bank, **args)
+            return bank
+        self._bank(bank)
+        if kind == 'customer':
+            return Customer(bank, **args).customer_id
+        if kind == 'savings':
+            return SavingsAccount(bank, **args).account_id
+        if kind == 'checking':
+            return CheckingAccount(bank, **args).account_id
+        if kind == 'card':
+            card = CreditCard(bank, **args)
+            return {'card_number':card._card_number, 'cvv':card.cvv}
+        raise ValueError(f'Cannot create a {kind}')
+
+    def _op_deposit(self, bank, account_id, amount):
+        '''Deposits into an account and returns its balance'''
+        account = self._account(bank, account_id)
+        account.deposit(amount)
+        return account._balance
+
+    def _op_withdraw(self, bank, account_id, amount, confirm=False):
+        '''Withdraws from an account and returns its balance, overdraft fees are only charged if confirmed'''
+        account = self._account(bank, account_id)
+        if isinstance(account, CheckingAccount):
+            account.withdraw(amount, confirm)
+        else:
+            account.withdraw(amount)
+        return account._balance
+
+    def _op_spend(self, bank, card_number, amount, cvv, note=None):
+        '''Makes a purchase on a credit card and returns its current balance'''
+        card = self._card(bank, card_number)
+        card.spend(amount, cvv, note)
+        return card._current_balance
+
+    def _op_pay(self, bank, card_number, account_id, amount):
+        '''Pays a credit card from a checking account and returns the card's current balance'''
+        card = self._card(bank, card_number)
+        card.pay(account_id, amount)
+        return card._current_balance
+
+    def _op_next_month(self, bank):
+        '''Moves the bank to the next month'''
+        self._bank(bank).next_month()
+
+    def _op_balance(self, bank, account_id=None, card_number=None):
+        '''Gets the balance of an account, or the statement and current balance of a credit card'''
+        if card_number is not None:
+            card = self._card(bank, card_number)
+            card._catch_up()
+            return {'statement_balance':card._statement_balance, 'current_balance':card._current_balance}
+        account = self._account(bank, account_id)
+        account._catch_up()
+        return account._balance
+
+
+class BankClient:
+    '''
+    Client for a BankServer, keeping a pool of open connections that threads share
+
+    Attributes:
+        address (str or tuple) : Unix socket path, or (host, port) for localhost TCP
+        pool_size (int, optional) : The most idle connections kept open, defaults to 4
+
+    Methods:
+        call : sends one operation and returns its result
+        create, deposit, withdraw, spend, pay, next_month, balance : wrappers around call
+        close : closes the pooled connections
+    '''
+    def __init__(self, address, pool_size=4):
+        '''
+        BankClient object initialization function
+
+        Args:
+            address (str or tuple) : Unix socket path, or (host, port) for localhost TCP
+            pool_size (int, optional) : The most idle connections kept open, defaults to 4
+        '''
+        self._address = address
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self):
+        '''Opens a new connection to the server'''
+        if isinstance(self._address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(self._address if isinstance(self._address, str) else tuple(self._address))
+        return sock, sock.makefile('rwb')
+
+    def call(self, op, **args):
+        '''
+        Sends one operation to the server and waits for it to be committed
+
+        Args:
+            op (str) : the operation name
+            **args : the operation arguments
+
+        Returns:
+            The result of the operation
+        '''
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        sock, stream = conn
+        try:
+            stream.write(json.dumps({'op':op, 'args':args}).encode('utf-8') + b'\n')
+            stream.flush()
+            reply = json.loads(stream.readline())
+        except (OSError, ValueError):
+            stream.close()
+            sock.close()
+            raise
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            stream.close()
+            sock.close()
+        if not reply['ok']:
+            raise ValueError(reply['error'])
+        return reply['result']
+
+    def create(self, kind, bank, **args):
+        '''Creates a bank, customer, savings account, checking account or credit card'''
+        return self.call('create', kind=kind, bank=bank, **args)
+
+    def deposit(self, bank, account_id, amount):
+        '''Deposits into an account'''
+        return self.call('deposit', bank=bank, account_id=account_id, amount=amount)
+
+    def withdraw(self, bank, account_id, amount, confirm=False):
+        '''Withdraws from an account'''
+        return self.call('withdraw', bank=bank, account_id=account_id, amount=amount, confirm=confirm)
+
+    def spend(self, bank, card_number, amount, cvv, note=None):
+        '''Makes a purchase on a credit card'''
+        return self.call('spend', bank=bank, card_number=card_number, amount=amount, cvv=cvv, note=note)
+
+    def pay(self, bank, card_number, account_id, amount):
+        '''Pays a credit card from a checking account'''
+        return self.call('pay', bank=bank, card_number=card_number, account_id=account_id, amount=amount)
+
+    def next_month(self, bank):
+        '''Moves the bank to the next month'''
+        return self.call('next_month', bank=bank)
+
+    def balance(self, bank, account_id=None, card_number=None):
+        '''Gets the balance of an account or credit card'''
+        return self.call('balance', bank=bank, account_id=account_id, card_number=card_number)
+
+    def close(self):
+        '''Closes the pooled connections'''
+        while True:
+            try:
+                sock, stream = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            stream.close()
+            sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves banks to local clients')
+    parser.add_argument('--socket', help='Unix socket path to listen on')
+    parser.add_argument('--port', type=int, help='localhost TCP port to listen on')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--batch-window', type=float, default=0.002)
+    options = parser.parse_args()
+    address = options.socket if options.socket else ('127.0.0.1', options.port or 8765)
+    BankServer(address, options.batch_size, options.batch_window).serve_forever()
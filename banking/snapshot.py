@@ -0,0 +1,551 @@
+import os
+import json
+import mmap
+import shutil
+import struct
+import numpy as np
+from operator import is_not
+from itertools import chain, repeat
+
+from banking.banking import file_path, logger, json_write, bank_export, bank_layout, snapshot_base, ENTITIES, ID_FIELDS, DEFAULT_SHARDS
+
+
+#Snapshot file layout:
+#   preamble  : magic bytes, format version and header length
+#   header    : json naming the bank, the month it is on and its risk rules, and describing each table, its row count and where each column lives in the file
+#   columns   : raw little endian buffers, each aligned to ALIGNMENT bytes so they can be mapped directly as numpy arrays
+MAGIC = b'BANKSNAP'
+VERSION = 1
+PREAMBLE = struct.Struct('<8sIQ')
+ALIGNMENT = 64
+KINDS = {'int':np.dtype('<i8'), 'float':np.dtype('<f8')}
+
+
+def _align(offset):
+    '''Rounds {offset} up to the next multiple of ALIGNMENT'''
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _column(values):
+    '''
+    Builds the column holding {values}, whole numbers as int64, other numbers as float64, dicts and lists as json and
+    everything else as strings
+
+    Args:
+        values (list) : the values of one field, None where a record does not have it
+
+    Returns:
+        tuple: the column, a bool mask of the values present or None if all are, and whether the column holds json
+    '''
+    kinds = set(map(type, values))
+    mask = None
+    if type(None) in kinds:
+        kinds.discard(type(None))
+        mask = np.fromiter(map(is_not, values, repeat(None)), dtype=bool, count=len(values))
+    if kinds <= {int}:
+        return np.array(values if mask is None else [0 if value is None else value for value in values], dtype=KINDS['int']), mask, False
+    if kinds <= {int, float}:
+        return np.array(values if mask is None else [np.nan if value is None else value for value in values], dtype=KINDS['float']), mask, False
+    if kinds <= {dict, list}:
+        return StringColumn.from_list([None if value is None else json.dumps(value) for value in values]), mask, True
+    return StringColumn.from_list(values), mask, False
+
+def _kind(column, is_json):
+    '''Gets the kind of {column} as stored in a snapshot header'''
+    if isinstance(column, StringColumn):
+        return 'json' if is_json else 'str'
+    return 'int' if column.dtype.kind in 'iu' else 'float'
+
+def _join(parts, order):
+    '''
+    Joins the parts of one column end to end and puts its rows in {order}
+
+    Args:
+        parts (list) : (column, mask, is_json, rows) of each part, the column is None for a part without the field
+        order (ndarray) : int array of the joined rows in the order they are kept
+
+    Returns:
+        tuple: the column, a bool mask of the values present or None if all are, and whether the column holds json
+    '''
+    kinds = {_kind(column, is_json) for column, _, is_json, _ in parts if column is not None}
+    mask = np.concatenate([np.zeros(rows, dtype=bool) if column is None else np.ones(rows, dtype=bool) if mask is None else mask
+                           for column, mask, _, rows in parts])[order]
+    mask = None if mask.all() else mask
+    if kinds <= {'int', 'float'}:
+        dtype = KINDS['float'] if 'float' in kinds else KINDS['int']
+        column = np.concatenate([np.zeros(rows, dtype=dtype) if column is None else column for column, _, _, rows in parts])
+        return column[order], mask, False
+    if len(kinds) == 1:
+        column = StringColumn.concat([StringColumn.from_list([None]*rows) if column is None else column for column, _, _, rows in parts])
+        return column.take(order), mask, kinds == {'json'}
+    #Parts stored as different kinds are decoded and stored again as one
+    values = []
+    for column, part_mask, is_json, rows in parts:
+        decoded = [None]*rows if column is None else column.tolist()
+        if is_json:
+            decoded = [json.loads(value) for value in decoded]
+        present = [True]*rows if part_mask is None else part_mask.tolist()
+        values.extend(value if keep else None for value, keep in zip(decoded, present))
+    return _column([values[row] for row in order.tolist()])
+
+
+class StringColumn:
+    '''
+    A column of strings stored as one utf-8 string table and the offsets of each string within it
+
+    Attributes:
+        offsets (ndarray) : int64 array of length rows+1, string i is data[offsets[i]:offsets[i+1]]
+        data (ndarray) : uint8 array holding the encoded strings back to back
+
+    Methods:
+        from_list : builds a column from a list of strings
+        concat : joins columns end to end
+        take : gets a column of the strings at some rows
+        tolist : decodes the column into a list of strings
+    '''
+    def __init__(self, offsets, data):
+        '''
+        StringColumn object initialization function
+
+        Args:
+            offsets (ndarray) : int64 string offsets
+            data (ndarray) : uint8 string table
+        '''
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_list(cls, values):
+        '''
+        Builds a column from a list of strings, missing values are stored as empty strings
+
+        Args:
+            values (list) : list of str or None
+
+        Returns:
+            StringColumn Class Object
+        '''
+        encoded = [b'' if value is None else str(value).encode('utf-8') for value in values]
+        offsets = np.zeros(len(encoded)+1, dtype=KINDS['int'])
+        np.cumsum(np.fromiter(map(len, encoded), dtype=KINDS['int'], count=len(encoded)), out=offsets[1:])
+        return cls(offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    @classmethod
+    def concat(cls, columns):
+        '''
+        Joins {columns} end to end, without decoding any string
+
+        Args:
+            columns (list) : StringColumn Class Objects
+
+        Returns:
+            StringColumn Class Object
+        '''
+        offsets, data, end = [np.zeros(1, dtype=KINDS['int'])], [], 0
+        for column in columns:
+            offsets.append(column.offsets[1:] - column.offsets[0] + end)
+            data.append(column.data[column.offsets[0]:column.offsets[-1]])
+            end += int(column.offsets[-1] - column.offsets[0])
+        return cls(np.concatenate(offsets), np.concatenate(data))
+
+    def take(self, rows):
+        '''
+        Gets a column of the strings at {rows}, in that order, without decoding any string
+
+        Args:
+            rows (ndarray) : int array of row numbers
+
+        Returns:
+            StringColumn Class Object
+        '''
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows+1] - starts
+        offsets = np.zeros(len(rows)+1, dtype=KINDS['int'])
+        np.cumsum(lengths, out=offsets[1:])
+        return StringColumn(offsets, self.data[np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])])
+
+    def __len__(self):
+        '''Returns the number of strings in the column'''
+        return len(self.offsets)-1
+
+    def __getitem__(self, i):
+        '''Decodes the string at row {i}'''
+        return self.data[self.offsets[i]:self.offsets[i+1]].tobytes().decode('utf-8')
+
+    def tolist(self):
+        '''Decodes the column into a list of strings'''
+        blob = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        return [blob[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+class Snapshot:
+    '''
+    Columnar binary snapshot of a whole bank
+
+    Each entity type is a table of columns. Whole number columns are int64, other numeric columns are float64,
+    columns of nested objects (e.g. account transfer 'Holds') are a StringColumn of json and everything else is a StringColumn. Columns that are missing from some records (e.g. 'Minimum Balance'
+    on checking accounts) carry a boolean mask of the rows where they are present.
+
+    Attributes:
+        bank_name (str) : The name of the bank
+        period (int) : The month the bank is on
+        rules (dict) : The bank's risk rules in the form stored in the manifest, None for the default rules
+        tables (dict) : {entity: {column name: ndarray or StringColumn}}
+        masks (dict) : {entity: {column name: bool ndarray}} for the columns with missing values
+        rows (dict) : {entity: number of rows}
+        nested (dict) : {entity: set of column names holding json encoded objects}
+
+    Methods:
+        from_json : builds a snapshot from bank data in the single file layout
+        to_json : converts the snapshot back to the single file layout
+        record : decodes one row of a table into a record
+        save : writes the snapshot to a file
+        load : maps a snapshot file into memory
+        overlay : builds a snapshot of this one with some records added or replaced
+    '''
+    def __init__(self, bank_name, tables, masks, rows, nested=None, period=0, rules=None):
+        '''
+        Snapshot object initialization function
+
+        Args:
+            bank_name (str) : The name of the bank
+            tables (dict) : {entity: {column name: ndarray or StringColumn}}
+            masks (dict) : {entity: {column name: bool ndarray}}
+            rows (dict) : {entity: number of rows}
+            nested (dict, optional) : {entity: set of column names holding json encoded objects}, defaults to none
+            period (int, optional) : The month the bank is on, defaults to 0
+            rules (dict, optional) : The bank's risk rules in the form stored in the manifest, defaults to None for
+                                     the default rules
+        '''
+        self.bank_name = bank_name
+        self.period = period
+        self.rules = rules
+        self.tables = tables
+        self.masks = masks
+        self.rows = rows
+        self.nested = {} if nested is None else nested
+
+    @classmethod
+    def from_json(cls, data):
+        '''
+        Builds a snapshot from bank data in the single file layout
+
+        Args:
+            data (dict) : bank data with a list of records for each entity type
+
+        Returns:
+            Snapshot Class Object
+        '''
+        tables, masks, rows, nested = {}, {}, {}, {}
+        for entity, records in data.items():
+            if not isinstance(records, list):
+                continue
+            tables[entity], masks[entity], rows[entity], nested[entity] = {}, {}, len(records), set()
+            for name in dict.fromkeys(chain.from_iterable(records)):
+                column, mask, is_json = _column([record.get(name) for record in records])
+                tables[entity][name] = column
+                if mask is not None:
+                    masks[entity][name] = mask
+                if is_json:
+                    nested[entity].add(name)
+        return cls(data['Bank Name'], tables, masks, rows, nested, data.get('Period', 0), data.get('Risk Rules'))
+
+    def overlay(self, data):
+        '''
+        Builds a snapshot of this one with the records in {data} laid over it, a record replaces the record of this
+        snapshot with the same id. Only the records in {data} are converted, the rest are copied column by column.
+
+        Args:
+            data (dict) : bank data with a list of records for each entity type, its name, period and risk rules
+                          are those of the new snapshot
+
+        Returns:
+            Snapshot Class Object
+        '''
+        changes = Snapshot.from_json(data)
+        tables, masks, rows, nested = {}, {}, {}, {}
+        for entity in dict.fromkeys(list(self.tables) + list(changes.tables)):
+            if not changes.rows.get(entity) or not self.rows.get(entity):
+                source = self if self.rows.get(entity) else changes
+                tables[entity], masks[entity] = source.tables[entity], source.masks[entity]
+                rows[entity], nested[entity] = source.rows[entity], source.nested.get(entity, set())
+                continue
+            key = ID_FIELDS[entity]
+            kept = np.flatnonzero(~np.isin(self.tables[entity][key], changes.tables[entity][key]))
+            order = np.argsort(np.concatenate([self.tables[entity][key][kept], changes.tables[entity][key]]), kind='stable')
+            tables[entity], masks[entity], rows[entity], nested[entity] = {}, {}, len(order), set()
+            for name in dict.fromkeys(list(self.tables[entity]) + list(changes.tables[entity])):
+                parts = []
+                for source, part_rows in [(self, kept), (changes, None)]:
+                    column = source.tables[entity].get(name)
+                    mask = source.masks[entity].get(name)
+                    if part_rows is not None and column is not None:
+                        column = column.take(part_rows) if isinstance(column, StringColumn) else column[part_rows]
+                    if part_rows is not None and mask is not None:
+                        mask = mask[part_rows]
+                    count = len(part_rows) if part_rows is not None else source.rows[entity]
+                    parts.append((column, mask, name in source.nested.get(entity, ()), count))
+                column, mask, is_json = _join(parts, order)
+                tables[entity][name] = column
+                if mask is not None:
+                    masks[entity][name] = mask
+                if is_json:
+                    nested[entity].add(name)
+        return Snapshot(data['Bank Name'], tables, masks, rows, nested, data.get('Period', 0), data.get('Risk Rules'))
+
+    def to_json(self):
+        '''
+        Converts the snapshot back to the single file layout
+
+        Returns:
+            dict: bank data with a list of records for each entity type
+        '''
+        data = {'Bank Name':self.bank_name, 'Period':self.period}
+        if self.rules is not None:
+            data['Risk Rules'] = self.rules
+        for entity, columns in self.tables.items():
+            records = [{} for _ in range(self.rows[entity])]
+            for name, column in columns.items():
+                mask = self.masks[entity].get(name)
+                present = [True]*len(records) if mask is None else mask.tolist()
+                values = column.tolist()
+                if name in self.nested.get(entity, ()):
+                    values = [json.loads(value) if keep else None for value, keep in zip(values, present)]
+                for record, value, keep in zip(records, values, present):
+                    if keep:
+                        record[name] = value
+            data[entity] = records
+        return data
+
+    def record(self, entity, row):
+        '''
+        Decodes one row of a table into a record, as it appears in the single file layout
+
+        Args:
+            entity (str) : The entity type
+            row (int) : The row in the table
+
+        Returns:
+            dict: the record
+        '''
+        record = {}
+        for name, column in self.tables[entity].items():
+            mask = self.masks[entity].get(name)
+            if mask is not None and not mask[row]:
+                continue
+            if isinstance(column, StringColumn):
+                record[name] = json.loads(column[row]) if name in self.nested.get(entity, ()) else column[row]
+            else:
+                record[name] = column[row].item()
+        return record
+
+    def save(self, file):
+        '''
+        Writes the snapshot to {file}
+
+        Args:
+            file (obj) : pathlib Path object of the snapshot file
+        '''
+        buffers, position = [], [0]
+        def place(array):
+            '''Queues {array} to be written at the next aligned position and returns that position'''
+            offset = _align(position[0])
+            buffer = memoryview(np.ascontiguousarray(array)).cast('B')
+            buffers.extend([bytes(offset - position[0]), buffer])
+            position[0] = offset + len(buffer)
+            return offset
+
+        header = {'Bank Name':self.bank_name, 'Period':self.period, 'Risk Rules':self.rules, 'Tables':{}}
+        for entity, columns in self.tables.items():
+            table = header['Tables'][entity] = {'Rows':self.rows[entity], 'Columns':[]}
+            for name, column in columns.items():
+                mask = self.masks[entity].get(name)
+                entry = {'Name':name, 'Mask':None if mask is None else place(mask.astype(np.uint8))}
+                if isinstance(column, StringColumn):
+                    entry.update({'Kind':'json' if name in self.nested.get(entity, ()) else 'str', 'Offsets':place(column.offsets), 'Data':place(column.data), 'Length':len(column.data)})
+                else:
+                    kind = 'int' if column.dtype.kind in 'iu' else 'float'
+                    entry.update({'Kind':kind, 'Offset':place(column.astype(KINDS[kind], copy=False))})
+                table['Columns'].append(entry)
+
+        header = json.dumps(header).encode('utf-8')
+        start = _align(PREAMBLE.size + len(header))
+        #Written beside the target and moved into place, so snapshots already mapped from {file} stay valid
+        temp = file.with_name(file.name + '.tmp')
+        with temp.open('wb') as f:
+            f.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+            f.write(header)
+            f.write(bytes(start - PREAMBLE.size - len(header)))
+            for buffer in buffers:
+                f.write(buffer)
+        os.replace(temp, file)
+        logger.info(f'Snapshot of {self.bank_name} written to {file}')
+
+    @classmethod
+    def load(cls, file):
+        '''
+        Maps the snapshot at {file} into memory, columns are numpy views of the file and are not copied
+
+        Args:
+            file (obj) : pathlib Path object of the snapshot file
+
+        Returns:
+            Snapshot Class Object
+        '''
+        with file.open('rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, length = PREAMBLE.unpack_from(mapped)
+        if magic != MAGIC or version != VERSION:
+            logger.error(ValueError(f'{file} is not a version {VERSION} bank snapshot'))
+            raise ValueError(f'{file} is not a version {VERSION} bank snapshot')
+        header = json.loads(mapped[PREAMBLE.size:PREAMBLE.size+length])
+        start = _align(PREAMBLE.size + length)
+
+        tables, masks, rows, nested = {}, {}, {}, {}
+        for entity, table in header['Tables'].items():
+            n = rows[entity] = table['Rows']
+            tables[entity], masks[entity], nested[entity] = {}, {}, set()
+            for entry in table['Columns']:
+                if entry['Mask'] is not None:
+                    masks[entity][entry['Name']] = np.frombuffer(mapped, dtype=bool, count=n, offset=start+entry['Mask'])
+                if entry['Kind'] == 'json':
+                    nested[entity].add(entry['Name'])
+                if entry['Kind'] in ('str', 'json'):
+                    tables[entity][entry['Name']] = StringColumn(
+                        np.frombuffer(mapped, dtype=KINDS['int'], count=n+1, offset=start+entry['Offsets']),
+                        np.frombuffer(mapped, dtype=np.uint8, count=entry['Length'], offset=start+entry['Data']))
+                else:
+                    tables[entity][entry['Name']] = np.frombuffer(mapped, dtype=KINDS[entry['Kind']], count=n, offset=start+entry['Offset'])
+        return cls(header['Bank Name'], tables, masks, rows, nested, header.get('Period', 0), header.get('Risk Rules'))
+
+
+class SnapshotBase:
+    '''
+    Looks up records by id in a mapped snapshot, for a bank restored from it. The bank reads a record from here until
+    the record is first written, from then on the record's shard holds it.
+
+    Methods:
+        record : gets a record by its id
+        records : gets the records that hash to one shard
+    '''
+    #The table and column each entity type is keyed by, the ssn index is the ssn column of the customers
+    KEYS = {entity:(entity, name) for entity, name in ID_FIELDS.items()}
+    KEYS['SSNs'] = ('Customers', 'SSN')
+
+    def __init__(self, file):
+        '''
+        SnapshotBase object initialization function
+
+        Args:
+            file (obj) : pathlib Path object of the snapshot file
+        '''
+        self._snapshot = Snapshot.load(file)
+        self._sorted = {}
+        self._shards = {}
+
+    def _keys(self, entity):
+        '''Gets the key column of {entity}, None if the snapshot has no records of that type'''
+        table, name = self.KEYS[entity]
+        return self._snapshot.tables.get(table, {}).get(name)
+
+    def _value(self, entity, row):
+        '''Decodes a row, the ssn index holds the customer id'''
+        if entity == 'SSNs':
+            return self._snapshot.tables['Customers']['Customer Id'][row].item()
+        return self._snapshot.record(entity, row)
+
+    def record(self, entity, key):
+        '''
+        Gets the record {key} of type {entity}
+
+        Args:
+            entity (str) : The entity type
+            key (int) : The id of the record
+
+        Returns:
+            The record, or None if the snapshot has no record with that id
+        '''
+        keys = self._keys(entity)
+        if keys is None:
+            return None
+        if entity not in self._sorted:
+            order = np.argsort(keys, kind='stable')
+            self._sorted[entity] = (order, keys[order])
+        order, ordered = self._sorted[entity]
+        i = int(np.searchsorted(ordered, int(key)))
+        if i == len(ordered) or ordered[i] != int(key):
+            return None
+        return self._value(entity, order[i])
+
+    def records(self, entity, index, shards):
+        '''
+        Gets the records of type {entity} that hash to shard {index} of {shards}
+
+        Args:
+            entity (str) : The entity type
+            index (int) : The index of the shard
+            shards (int) : The number of shards of type {entity}
+
+        Returns:
+            dict: records keyed by their id as a string
+        '''
+        keys = self._keys(entity)
+        if keys is None:
+            return {}
+        if (entity, shards) not in self._shards:
+            buckets = keys % shards
+            order = np.argsort(buckets, kind='stable')
+            self._shards[entity, shards] = (order, np.searchsorted(buckets[order], np.arange(shards+1)))
+        order, bounds = self._shards[entity, shards]
+        return {str(keys[row].item()):self._value(entity, row) for row in order[bounds[index]:bounds[index+1]]}
+
+
+def snapshot_save(bank_name, file=None):
+    '''
+    Writes a binary snapshot of the bank. A bank restored from a snapshot is saved by laying the records written since
+    over that snapshot, so only they are read from json.
+
+    Args:
+        bank_name (str) : The name of the bank
+        file (obj, optional) : pathlib Path object of the snapshot file, defaults to {bank}.snap in the data folder
+
+    Returns:
+        obj: pathlib Path object of the snapshot file
+    '''
+    file = file_path/f'{bank_name}.snap' if file is None else file
+    base = snapshot_base(bank_name)
+    if base is None:
+        Snapshot.from_json(bank_export(bank_name)).save(file)
+    else:
+        #Only the records written since the bank was restored are read from its shards, the rest are copied as columns
+        base._snapshot.overlay(bank_export(bank_name, written=True)).save(file)
+    return file
+
+def snapshot_restore(file, shards=DEFAULT_SHARDS):
+    '''
+    Restores the bank held in a binary snapshot. The snapshot is copied into the bank folder and the bank reads its
+    records from there, so nothing is converted to json until a record is written.
+
+    Args:
+        file (obj) : pathlib Path object of the snapshot file
+        shards (int, optional) : The number of shards each entity type starts with, defaults to DEFAULT_SHARDS
+
+    Returns:
+        str: The name of the restored bank
+    '''
+    snapshot = Snapshot.load(file)
+    bank_name = snapshot.bank_name
+    #Copied aside first, {file} may be the snapshot of the bank being replaced
+    temp = file_path/f'{bank_name}.snap.tmp'
+    shutil.copyfile(file, temp)
+    manifest = bank_layout(bank_name, shards, {entity:snapshot.rows.get(entity, 0) for entity in ENTITIES},
+                           snapshot.period, snapshot.rules)
+    os.replace(temp, file_path/bank_name/'snapshot.snap')
+    for entity in ENTITIES:
+        if snapshot.rows.get(entity) and ID_FIELDS[entity] in snapshot.tables[entity]:
+            manifest['Next Id'][entity] = int(snapshot.tables[entity][ID_FIELDS[entity]].max())+1
+    manifest['Snapshot'] = 'snapshot.snap'
+    json_write(file_path/f'{bank_name}.json', manifest)
+    logger.info(f'Bank {bank_name} restored from the snapshot {file}')
+    return bank_name
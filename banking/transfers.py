@@ -0,0 +1,296 @@
+'''
+Transfers between any two accounts, in the same bank or in different banks
+
+Every batch of transfers goes through a two phase commit recorded in an append only recovery log:
+
+    prepare : the batch is logged, then each source account moves the amount out of its balance into a hold
+              and each destination account records a pending credit. Holds live in the account record keyed by
+              transfer and side, so each step is a single shard write and repeating it is harmless
+    commit  : the decision is logged, then destination credits are applied and all holds are dropped
+    abort   : source holds are refunded and destination holds are dropped
+    done    : once every participant has applied the decision the batch needs no recovery and its entries are cleared
+
+Each engine has its own recovery log in the transfers folder, locked for as long as the engine is alive. On start up
+TransferEngine replays the logs no live engine holds. A batch with a logged commit is committed again, a batch that
+only reached prepare is aborted, so a crash never loses or duplicates money. A batch that fails while its engine
+keeps running is finished the same way straight away. Transfers are grouped by bank pair and each group is one batch,
+with each bank writing every shard it touches once per phase.
+'''
+import os
+import json
+import fcntl
+import threading
+from uuid import uuid4
+
+from banking.banking import file_path, logger, batch, Bank, SavingsAccount
+
+
+class TransferEngine:
+    '''
+    Moves funds between accounts with a two phase commit and a recovery log
+
+    Attributes:
+        directory (obj, optional) : pathlib Path object of the folder of recovery logs, defaults to transfers in the data folder
+
+    Methods:
+        transfer : moves funds between two accounts straight away
+        submit : queues a transfer for the next flush
+        flush : commits the queued transfers, one batch per bank pair
+        recover : finishes or rolls back the batches left in the logs of engines that are gone
+        close : releases the engine's recovery log
+    '''
+    def __init__(self, directory=None):
+        '''
+        TransferEngine object initialization function, creates and locks the engine's recovery log and then recovers
+        the batches left unfinished by engines that are gone
+
+        Args:
+            directory (obj, optional) : pathlib Path object of the folder of recovery logs, defaults to transfers in the data folder
+        '''
+        self._directory = file_path/'transfers' if directory is None else directory
+        self._directory.mkdir(parents=True, exist_ok=True)
+        #The log is locked before it gets its .log name, so recover never mistakes a starting engine for a dead one
+        name = uuid4().hex
+        self._file = (self._directory/f'{name}.tmp').open('a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._log = self._directory/f'{name}.log'
+        os.rename(self._directory/f'{name}.tmp', self._log)
+        self._lock = threading.Lock()
+        #True while the log holds no entries, a batch that fails part way leaves its entries behind for recovery
+        self._clean = True
+        self._pending = []
+        self._opened = {}
+        self.recover()
+
+    def transfer(self, from_bank, from_account, to_bank, to_account, amount):
+        '''
+        Moves {amount} from one account to another straight away
+
+        Args:
+            from_bank (str) : The name of the bank holding the source account
+            from_account (int) : The source account id
+            to_bank (str) : The name of the bank holding the destination account
+            to_account (int) : The destination account id
+            amount (float) : Dollar amount to be moved
+        '''
+        key = self.submit(from_bank, from_account, to_bank, to_account, amount)
+        result = self.flush()[key]
+        if result != 'committed':
+            raise ValueError(result)
+
+    def submit(self, from_bank, from_account, to_bank, to_account, amount):
+        '''
+        Queues a transfer to be committed by the next flush
+
+        Args:
+            from_bank (str) : The name of the bank holding the source account
+            from_account (int) : The source account id
+            to_bank (str) : The name of the bank holding the destination account
+            to_account (int) : The destination account id
+            amount (float) : Dollar amount to be moved
+
+        Returns:
+            str: the transfer key used in the results of flush
+        '''
+        if amount <= 0:
+            logger.error(ValueError('Transfer amount must be positive'))
+            raise ValueError('Transfer amount must be positive')
+        key = uuid4().hex
+        self._pending.append({'Key':key, 'From Bank':from_bank, 'From Account':from_account,
+                              'To Bank':to_bank, 'To Account':to_account, 'Amount':amount})
+        return key
+
+    def flush(self):
+        '''
+        Commits every queued transfer, grouping them into one batch per bank pair
+
+        Returns:
+            dict: 'committed' or the reason it was declined, for each transfer key
+        '''
+        with self._lock:
+            groups = {}
+            for transfer in self._pending:
+                groups.setdefault((transfer['From Bank'], transfer['To Bank']), []).append(transfer)
+            self._pending = []
+            results = {}
+            try:
+                for transfers in groups.values():
+                    results.update(self._run(transfers))
+            finally:
+                self._close_banks()
+            return results
+
+    def _account(self, bank_name, account_id):
+        '''Gets an account object, opening its bank from the bank database if it is not open'''
+        if bank_name not in self._opened and all(bank.name != bank_name for bank in Bank.__BANKS__):
+            self._opened[bank_name] = Bank.open(bank_name)
+        return Bank.open(bank_name).account(account_id)
+
+    def _close_banks(self):
+        '''Closes the banks this engine opened, leaving banks that were already open alone'''
+        for bank in self._opened.values():
+            bank.close()
+        self._opened = {}
+
+    def _run(self, transfers):
+        '''Runs one batch of transfers between a bank pair through prepare and commit'''
+        batch_id = uuid4().hex
+        clean, self._clean = self._clean, False
+        self._append({'Batch':batch_id, 'State':'prepare', 'Transfers':transfers})
+
+        results = {}
+        accepted = []
+        committed = False
+        try:
+            with batch():
+                for transfer in transfers:
+                    try:
+                        self._prepare_debit(transfer)
+                        results[transfer['Key']] = 'committed'
+                    except ValueError as e:
+                        results[transfer['Key']] = str(e)
+            accepted = [transfer for transfer in transfers if results[transfer['Key']] == 'committed']
+            with batch():
+                for transfer in accepted:
+                    self._prepare_credit(transfer)
+
+            self._append({'Batch':batch_id, 'State':'commit', 'Keys':[transfer['Key'] for transfer in accepted]})
+            committed = True
+            self._finish(accepted, commit=True)
+        except Exception:
+            #The engine is still running and holds its log, so it finishes its own batch the way recovery would.
+            #Only a crash leaves a batch for recovery.
+            if committed:
+                self._finish(accepted, commit=True)
+            else:
+                self._finish(transfers, commit=False)
+            self._settle(batch_id, clean)
+            raise
+        self._settle(batch_id, clean)
+        for transfer in accepted:
+            logger.info('Transfer {} moved ${:0,.2f} from account {} at {} to account {} at {}'.format(
+                transfer['Key'], transfer['Amount'], transfer['From Account'], transfer['From Bank'], transfer['To Account'], transfer['To Bank']))
+        return results
+
+    def _settle(self, batch_id, clean):
+        '''Marks a finished batch as needing no recovery, emptying the log if it held nothing else'''
+        if clean:
+            self._file.truncate(0)
+            self._clean = True
+        else:
+            self._append({'Batch':batch_id, 'State':'done'})
+
+    def _prepare_debit(self, transfer):
+        '''Moves the amount out of the source balance into a hold, declining if the account cannot cover it'''
+        account = self._account(transfer['From Bank'], transfer['From Account'])
+        self._account(transfer['To Bank'], transfer['To Account'])
+        if transfer['Key'] + ':debit' in account._holds:
+            return
+        account._catch_up()
+        floor = account._minimum_balance if isinstance(account, SavingsAccount) else 0
+        if account._balance - transfer['Amount'] < floor:
+            raise ValueError('The account {} cannot withstand a transfer of ${:0,.2f}'.format(account._account_id, transfer['Amount']))
+        account._balance -= transfer['Amount']
+        account._holds[transfer['Key'] + ':debit'] = -transfer['Amount']
+        account._save('transfer')
+
+    def _prepare_credit(self, transfer):
+        '''Records the pending credit on the destination account'''
+        account = self._account(transfer['To Bank'], transfer['To Account'])
+        if transfer['Key'] + ':credit' not in account._holds:
+            account._holds[transfer['Key'] + ':credit'] = transfer['Amount']
+            account._save()
+
+    def _finish(self, transfers, commit):
+        '''
+        Applies the commit or abort decision to both sides of each transfer, once per bank. An account or bank that
+        does not exist holds nothing, as a transfer to or from it was declined at prepare.
+        '''
+        for side, hold_key in [('From', ':debit'), ('To', ':credit')]:
+            with batch():
+                for transfer in transfers:
+                    try:
+                        account = self._account(transfer[f'{side} Bank'], transfer[f'{side} Account'])
+                    except ValueError:
+                        continue
+                    hold = account._holds.pop(transfer['Key'] + hold_key, None)
+                    if hold is None:
+                        continue
+                    account._catch_up()
+                    if (commit and hold > 0) or (not commit and hold < 0):
+                        account._balance += abs(hold)
+                    account._save('transfer')
+
+    def _append(self, entry):
+        '''Appends an entry to the recovery log and forces it to disk'''
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def recover(self):
+        '''
+        Finishes the batches left in the recovery logs of engines that are gone, committing those with a logged commit
+        and aborting the rest, then removes those logs. Logs locked by a live engine are left alone.
+
+        Returns:
+            int: the number of batches recovered
+        '''
+        recovered = 0
+        with self._lock:
+            try:
+                for log in sorted(self._directory.glob('*.log')):
+                    if log == self._log:
+                        continue
+                    try:
+                        f = log.open('r+')
+                    except FileNotFoundError:
+                        continue
+                    with f:
+                        try:
+                            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+                        recovered += self._recover_log(f)
+                        #Emptied before it is removed, so an engine that opened it meanwhile finds nothing to redo
+                        f.truncate(0)
+                        log.unlink(missing_ok=True)
+            finally:
+                self._close_banks()
+        return recovered
+
+    def _recover_log(self, f):
+        '''Finishes the batches in one recovery log and returns how many there were'''
+        batches = {}
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            batches.setdefault(entry['Batch'], {})[entry['State']] = entry
+
+        recovered = 0
+        for batch_id, states in batches.items():
+            if 'prepare' not in states or 'done' in states:
+                continue
+            transfers = states['prepare']['Transfers']
+            if 'commit' in states:
+                #The commit lists the transfers that were prepared, the rest were declined and hold nothing
+                keys = set(states['commit']['Keys'])
+                self._finish([transfer for transfer in transfers if transfer['Key'] in keys], commit=True)
+            else:
+                self._finish(transfers, commit=False)
+            logger.info(f'Transfer batch {batch_id} recovered with {"commit" if "commit" in states else "abort"}')
+            recovered += 1
+        return recovered
+
+    def close(self):
+        '''
+        Releases the engine's recovery log, removing it if no batch was left unfinished. A log left behind is
+        recovered by the next engine to start.
+        '''
+        with self._lock:
+            if self._file.closed:
+                return
+            if os.fstat(self._file.fileno()).st_size == 0:
+                self._log.unlink(missing_ok=True)
+            self._file.close()
@@ -0,0 +1,226 @@
+'''
+Deterministic synthetic workloads for load testing the banking module
+
+A workload is a trace: a list of operations saved one json object per line. The first line is a header, then the
+setup operations that build the banks, customers, accounts and cards, then a seeded mix of deposits, withdrawals,
+card spends, card payments and month ends. Operations refer to banks, accounts and cards by the order they were
+created in, so a trace replays the same way against fresh banks under any names.
+
+Usage:
+    python -m banking.workload generate trace.jsonl --seed 1 --customers 1000 --operations 100000
+    python -m banking.workload replay trace.jsonl --rate 500
+'''
+import os
+import json
+import time
+import pathlib
+import argparse
+import contextlib
+from math import log
+from random import Random
+import numpy as np
+
+from banking.banking import DEFAULT_SHARDS, Bank, Customer, SavingsAccount, CheckingAccount, CreditCard
+
+
+SETUP = ['bank', 'customer', 'savings', 'checking', 'card']
+#Share of each operation in the generated mix, month ends are placed every {ops_per_month} operations instead
+MIX = {'deposit':0.30, 'withdraw':0.20, 'spend':0.38, 'pay':0.12}
+
+
+def generate(seed=0, banks=1, customers=100, operations=10000, ops_per_month=1000, shards=DEFAULT_SHARDS):
+    '''
+    Generates a workload trace
+
+    Args:
+        seed (int, optional) : Random seed, the same arguments always give the same trace, defaults to 0
+        banks (int, optional) : The number of banks, defaults to 1
+        customers (int, optional) : The number of customers per bank, defaults to 100
+        operations (int, optional) : The number of operations after setup, defaults to 10000
+        ops_per_month (int, optional) : Operations between month ends, defaults to 1000
+        shards (int, optional) : The number of shards per entity type in each bank, defaults to DEFAULT_SHARDS
+
+    Returns:
+        list: the trace, a header followed by operations
+    '''
+    rand = Random(seed)
+    trace = [{'Trace':1, 'Seed':seed, 'Banks':[f'Workload {seed} Bank {b}' for b in range(banks)]}]
+    checking, savings, cards = [], [], []
+    for b in range(banks):
+        trace.append({'Op':'bank', 'Bank':b, 'Shards':shards})
+        accounts, bank_cards = 0, 0
+        for c in range(customers):
+            trace.append({'Op':'customer', 'Bank':b, 'Customer':c, 'SSN':100000000 + b*customers + c,
+                          'First Name':f'First{c}', 'Last Name':f'Last{c}', 'Address':f'{rand.randint(1, 9999)} Main st'})
+            own_checking = accounts
+            trace.append({'Op':'checking', 'Bank':b, 'Customer':c, 'Account':accounts, 'Balance':round(rand.lognormvariate(log(1500), 1), 2)})
+            checking.append((b, accounts))
+            accounts += 1
+            if rand.random() < 0.5:
+                trace.append({'Op':'savings', 'Bank':b, 'Customer':c, 'Account':accounts, 'Balance':round(500 + rand.lognormvariate(log(5000), 1), 2)})
+                savings.append((b, accounts))
+                accounts += 1
+            if rand.random() < 0.7:
+                trace.append({'Op':'card', 'Bank':b, 'Customer':c, 'Card':bank_cards, 'Limit':rand.choice([1000, 2500, 5000, 10000])})
+                cards.append((b, bank_cards, own_checking))
+                bank_cards += 1
+
+    ops, weights = list(MIX), list(MIX.values())
+    all_accounts = checking + savings
+    for i in range(operations):
+        if ops_per_month and i and i % ops_per_month == 0:
+            for b in range(banks):
+                trace.append({'Op':'next_month', 'Bank':b})
+        op = rand.choices(ops, weights)[0]
+        if op in ('deposit', 'withdraw'):
+            b, account = rand.choice(all_accounts)
+            median = 400 if op == 'deposit' else 120
+            trace.append({'Op':op, 'Bank':b, 'Account':account, 'Amount':round(rand.lognormvariate(log(median), 0.8), 2)})
+        elif cards and op == 'spend':
+            b, card, _ = rand.choice(cards)
+            trace.append({'Op':op, 'Bank':b, 'Card':card, 'Amount':round(rand.lognormvariate(log(40), 1), 2), 'CVV Ok':rand.random() > 0.01})
+        elif cards:
+            b, card, account = rand.choice(cards)
+            trace.append({'Op':op, 'Bank':b, 'Card':card, 'Account':account, 'Amount':round(rand.lognormvariate(log(150), 0.8), 2)})
+    return trace
+
+def save_trace(trace, file):
+    '''
+    Saves a trace one json object per line
+
+    Args:
+        trace (list) : the trace
+        file (obj) : pathlib Path object of the trace file
+    '''
+    with file.open('w') as f:
+        for entry in trace:
+            f.write(json.dumps(entry) + '\n')
+
+def load_trace(file):
+    '''
+    Loads a trace saved by save_trace
+
+    Args:
+        file (obj) : pathlib Path object of the trace file
+
+    Returns:
+        list: the trace
+    '''
+    with file.open('r') as f:
+        trace = [json.loads(line) for line in f if line.strip()]
+    if not trace or trace[0].get('Trace') != 1:
+        raise ValueError(f'{file} is not a workload trace')
+    return trace
+
+
+def replay(trace, rate=None, banks=None, quiet=True):
+    '''
+    Replays a trace against the banking module, timing each operation after setup
+
+    Args:
+        trace (list) : the trace
+        rate (float, optional) : Target operations per second, defaults to None for as fast as possible
+        banks (list, optional) : Bank names to use in place of the names in the trace header, defaults to None
+        quiet (bool, optional) : Hides what the banking module prints, defaults to True
+
+    Returns:
+        dict: operation count, seconds, throughput, latency percentiles in milliseconds and errors per operation
+    '''
+    names = banks if banks is not None else trace[0]['Banks']
+    state = {'banks':{}, 'accounts':{}, 'cards':{}, 'customers':{}}
+    output = open(os.devnull, 'w') if quiet else None
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+        operations = [entry for entry in trace[1:] if entry['Op'] not in SETUP]
+        for entry in trace[1:]:
+            if entry['Op'] in SETUP:
+                _apply(entry, names, state)
+
+        latencies = np.zeros(len(operations))
+        counts, errors = {}, {}
+        start = time.perf_counter()
+        for i, entry in enumerate(operations):
+            scheduled = start + i/rate if rate else time.perf_counter()
+            if rate:
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                _apply(entry, names, state)
+            except ValueError:
+                errors[entry['Op']] = errors.get(entry['Op'], 0) + 1
+            counts[entry['Op']] = counts.get(entry['Op'], 0) + 1
+            latencies[i] = time.perf_counter() - scheduled
+        seconds = time.perf_counter() - start
+    if quiet:
+        output.close()
+    for bank in state['banks'].values():
+        bank.close()
+
+    percentiles = np.percentile(latencies, [50, 95, 99]) * 1000 if len(operations) else [0, 0, 0]
+    return {'Operations':len(operations), 'Seconds':seconds, 'Throughput':len(operations)/seconds if seconds else 0,
+            'Latency p50':percentiles[0], 'Latency p95':percentiles[1], 'Latency p99':percentiles[2],
+            'Latency max':latencies.max()*1000 if len(operations) else 0, 'Counts':counts, 'Errors':errors}
+
+def _apply(entry, names, state):
+    '''Applies one trace operation'''
+    op, b = entry['Op'], entry['Bank']
+    name = names[b]
+    if op == 'bank':
+        state['banks'][b] = Bank(name, entry['Shards'])
+    elif op == 'customer':
+        state['customers'][b, entry['Customer']] = Customer(name, entry['SSN'], entry['First Name'], entry['Last Name'], entry['Address'])
+    elif op == 'checking':
+        state['accounts'][b, entry['Account']] = CheckingAccount(name, state['customers'][b, entry['Customer']].customer_id, entry['Balance'])
+    elif op == 'savings':
+        state['accounts'][b, entry['Account']] = SavingsAccount(name, state['customers'][b, entry['Customer']].customer_id, entry['Balance'])
+    elif op == 'card':
+        state['cards'][b, entry['Card']] = CreditCard(name, state['customers'][b, entry['Customer']].customer_id, entry['Limit'])
+    elif op == 'deposit':
+        state['accounts'][b, entry['Account']].deposit(entry['Amount'])
+    elif op == 'withdraw':
+        account = state['accounts'][b, entry['Account']]
+        if isinstance(account, CheckingAccount):
+            account.withdraw(entry['Amount'], confirm=False)
+        else:
+            account.withdraw(entry['Amount'])
+    elif op == 'spend':
+        card = state['cards'][b, entry['Card']]
+        card.spend(entry['Amount'], card.cvv if entry['CVV Ok'] else card.cvv+1)
+    elif op == 'pay':
+        card = state['cards'][b, entry['Card']]
+        card.pay(state['accounts'][b, entry['Account']].account_id, entry['Amount'])
+    elif op == 'next_month':
+        state['banks'][b].next_month()
+    else:
+        raise ValueError(f'Unknown trace operation {op}')
+
+def format_report(report):
+    '''Formats a replay report for printing'''
+    lines = ['{:,} operations in {:.2f}s, {:,.0f} ops/s'.format(report['Operations'], report['Seconds'], report['Throughput']),
+             'latency ms  p50 {:.3f}  p95 {:.3f}  p99 {:.3f}  max {:.3f}'.format(report['Latency p50'], report['Latency p95'], report['Latency p99'], report['Latency max'])]
+    for op, count in sorted(report['Counts'].items()):
+        lines.append('  {:<10} {:>10,}  declined {:,}'.format(op, count, report['Errors'].get(op, 0)))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates and replays banking workloads')
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate_parser = commands.add_parser('generate', help='generates a trace file')
+    generate_parser.add_argument('file')
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--banks', type=int, default=1)
+    generate_parser.add_argument('--customers', type=int, default=100)
+    generate_parser.add_argument('--operations', type=int, default=10000)
+    generate_parser.add_argument('--ops-per-month', type=int, default=1000)
+    generate_parser.add_argument('--shards', type=int, default=DEFAULT_SHARDS)
+    replay_parser = commands.add_parser('replay', help='replays a trace file')
+    replay_parser.add_argument('file')
+    replay_parser.add_argument('--rate', type=float, default=None, help='operations per second, defaults to as fast as possible')
+    replay_parser.add_argument('--banks', nargs='*', default=None, help='bank names to use in place of those in the trace')
+    options = parser.parse_args()
+
+    if options.command == 'generate':
+        save_trace(generate(options.seed, options.banks, options.customers, options.operations, options.ops_per_month, options.shards), pathlib.Path(options.file))
+    else:
+        print(format_report(replay(load_trace(pathlib.Path(options.file)), options.rate, options.banks)))
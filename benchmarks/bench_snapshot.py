@@ -0,0 +1,95 @@
+'''
+Compares saving and restoring a large bank as a json file against the binary snapshot format, end to end: from the
+bank's sharded storage to the file and back to a bank that can serve lookups. Saving is timed for a bank kept in json
+shards, and for the bank restored from the snapshot after {changes} deposits, which is saved by laying the records
+written since over the snapshot it was restored from
+
+Usage:
+    python benchmarks/bench_snapshot.py [accounts] [changes]
+'''
+import sys
+import time
+import pathlib
+import tempfile
+from random import Random
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import banking.banking
+import banking.snapshot
+from banking.banking import Bank, json_write, json_load, bank_export, bank_import
+from banking.snapshot import snapshot_save, snapshot_restore
+
+
+def build_bank(accounts, seed=0):
+    '''
+    Builds bank data in the single file layout with {accounts} accounts, a customer for every 4 accounts and a card per customer
+
+    Args:
+        accounts (int) : The number of accounts
+        seed (int, optional) : Random seed, defaults to 0
+
+    Returns:
+        dict: bank data
+    '''
+    rand = Random(seed)
+    customers = accounts // 4
+    data = {'Bank Name':'Benchmark Bank', 'Customers':[], 'Accounts':[], 'Credit Cards':[], 'Loans':[]}
+    for i in range(customers):
+        data['Customers'].append({'Customer Id':10001+i, 'SSN':100000000+i, 'First Name':f'First{i}', 'Last Name':f'Last{i}', 'Address':f'{i} Main st, New York NY 10001'})
+        data['Credit Cards'].append({'Customer Id':10001+i, 'Card Number':1234123412340001+i, 'CVV':rand.randint(100, 999), 'Credit Limit':1000, 'APR':0.26,
+                                     'Statement Balance':round(rand.uniform(0, 500), 2), 'Current Balance':round(rand.uniform(0, 1000), 2)})
+    for i in range(accounts):
+        account = {'Account Id':90001+i, 'Customer Id':10001+i % customers, 'Balance':round(rand.uniform(0, 10000), 2)}
+        if i % 2:
+            account.update({'Type':'S', 'Minimum Balance':500, 'Interest Rate':0.005})
+        else:
+            account.update({'Type':'C', 'Overdraft Limit':100.0, 'Overdraft Fee':25})
+        data['Accounts'].append(account)
+    return data
+
+def timed(function):
+    '''Runs {function} and returns its result and the seconds it took'''
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main(accounts, changes=1000):
+    folder = pathlib.Path(tempfile.mkdtemp())
+    banking.banking.file_path = banking.snapshot.file_path = folder
+    data = build_bank(accounts)
+    bank_import(data)
+    json_file, snap_file = folder/'bank backup.json', folder/'bank backup.snap'
+    sample = data['Accounts'][len(data['Accounts'])//2]
+
+    def lookup():
+        '''Opens the restored bank and reads one account, the first thing a restored bank is used for'''
+        bank = Bank.open(data['Bank Name'])
+        balance = bank.account(sample['Account Id'])._balance
+        bank.close()
+        return balance
+
+    _, json_save_time = timed(lambda: json_write(json_file, bank_export(data['Bank Name'])))
+    _, snap_save_time = timed(lambda: snapshot_save(data['Bank Name'], snap_file))
+    _, json_restore_time = timed(lambda: bank_import(json_load(json_file)))
+    json_balance, json_lookup_time = timed(lookup)
+    _, snap_restore_time = timed(lambda: snapshot_restore(snap_file))
+    snap_balance, snap_lookup_time = timed(lookup)
+    assert json_balance == snap_balance == sample['Balance']
+
+    bank = Bank.open(data['Bank Name'])
+    for account in data['Accounts'][::max(1, len(data['Accounts'])//changes)][:changes]:
+        bank.account(account['Account Id']).deposit(1)
+    bank.close()
+    _, json_resave_time = timed(lambda: json_write(json_file, bank_export(data['Bank Name'])))
+    _, snap_resave_time = timed(lambda: snapshot_save(data['Bank Name'], snap_file))
+
+    print(f'{accounts:,} accounts, json {json_file.stat().st_size/2**20:,.1f} MiB, snapshot {snap_file.stat().st_size/2**20:,.1f} MiB')
+    print(f'save     json {json_save_time:8.3f}s   snapshot {snap_save_time:8.3f}s   {json_save_time/snap_save_time:8.1f}x')
+    print(f'resave   json {json_resave_time:8.3f}s   snapshot {snap_resave_time:8.3f}s   {json_resave_time/snap_resave_time:8.1f}x   after restoring and {changes:,} deposits')
+    print(f'restore  json {json_restore_time:8.3f}s   snapshot {snap_restore_time:8.3f}s   {json_restore_time/snap_restore_time:8.1f}x')
+    print(f'first lookup after restore, json {json_lookup_time:.3f}s, snapshot {snap_lookup_time:.3f}s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000, int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
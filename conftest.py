@@ -0,0 +1,15 @@
+import banking.banking
+import banking.snapshot
+import banking.transfers
+from banking.banking import Bank
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def data_folder(tmp_path, monkeypatch):
+    '''Keeps each test's banks in a temporary data folder and unloads the banks it opened'''
+    for module in [banking.banking, banking.snapshot, banking.transfers]:
+        monkeypatch.setattr(module, 'file_path', tmp_path)
+    yield tmp_path
+    for bank in list(Bank.__BANKS__):
+        bank.close()
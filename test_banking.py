@@ -1,8 +1,22 @@
+import gc
+import json
+import pathlib
 import banking.banking
 from banking.banking import Bank, SavingsAccount, CheckingAccount, Customer, CreditCard
 import pytest
 
 
+def record_writes(monkeypatch):
+    '''Records the files written to disk, leaving out the writes held back by a batch'''
+    written = []
+    json_write = banking.banking.json_write
+    def recording_write(file, data, changed=None):
+        if getattr(banking.banking._batch, 'pending', None) is None:
+            written.append(file)
+        json_write(file, data, changed)
+    monkeypatch.setattr(banking.banking, 'json_write', recording_write)
+    return written
+
 def test_bank():
     bank = Bank('bank test')
     assert bank.name == 'bank test'
@@ -132,3 +146,189 @@ def test_credit_card():
     bank.next_month()
     assert JeffsCard.statement_balance == '$0.00'
     assert JeffsCard.current_balance == '$0.00'
+
+def test_sharded_storage(monkeypatch):
+    bank = Bank('Seventh Bank and Trust', shards=4)
+    bank_name = bank.name
+    Jeff = Customer(bank_name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsSavings = SavingsAccount(bank_name, Jeff.customer_id)
+    JeffsCard = CreditCard(bank_name, Jeff.customer_id)
+    written = record_writes(monkeypatch)
+    JeffsCard.spend(100, JeffsCard.cvv)
+    assert written == [JeffsCard._file]
+    written.clear()
+    JeffsSavings.deposit(100)
+    Jeff.lname = 'Abraham'
+    assert written == [JeffsSavings._file, Jeff._file]
+    data = banking.banking.bank_export(bank_name)
+    assert data['Credit Cards'][0]['Current Balance'] == 100
+    assert data['Accounts'][0]['Balance'] == 600
+    assert data['Customers'][0]['Last Name'] == 'Abraham'
+    data['Bank Name'] = 'Eighth Bank and Trust'
+    banking.banking.bank_import(data, shards=2)
+    assert banking.banking.bank_export('Eighth Bank and Trust')['Accounts'] == data['Accounts']
+    with pytest.raises(ValueError) as execinfo:
+        _ = Customer('Eighth Bank and Trust', 123456789, 'Jeff', 'Abe', '1234 Main st')
+    assert str(execinfo.value) == 'A customer already exists with the ssn supplied'
+
+def test_shard_split(monkeypatch):
+    monkeypatch.setattr(banking.banking, 'RECORDS_PER_SHARD', 4)
+    bank = Bank('Fourteenth Bank and Trust', shards=2)
+    customers = [Customer(bank.name, 100000000 + i, 'Jeff', 'Abe', '1234 Main st') for i in range(20)]
+    accounts = [CheckingAccount(bank.name, cust.customer_id, 100) for cust in customers]
+    manifest = banking.banking.json_load(banking.banking.file_path/f'{bank.name}.json')
+    assert manifest['Entity Shards'] == {'Customers':8, 'SSNs':8, 'Accounts':8}
+    assert max(len(banking.banking.shard_load(account._file)) for account in accounts) <= 4
+    accounts[0].deposit(5)
+    with pytest.raises(ValueError):
+        Customer(bank.name, 100000019, 'Jeff', 'Abe', '1234 Main st')
+    bank.close()
+    reopened = Bank.open('Fourteenth Bank and Trust')
+    assert reopened.account(accounts[0].account_id).balance == 'Customer 10001 Balance is: $105.00'
+    assert [record['Customer Id'] for record in banking.banking.shard_records(bank.name, 'Customers')] == list(range(10001, 10021))
+    data = banking.banking.bank_export(bank.name)
+    data['Bank Name'] = 'Fifteenth Bank and Trust'
+    banking.banking.bank_import(data, shards=2)
+    assert banking.banking.json_load(banking.banking.file_path/'Fifteenth Bank and Trust.json')['Entity Shards']['Accounts'] == 8
+    assert banking.banking.bank_export('Fifteenth Bank and Trust')['Accounts'] == data['Accounts']
+
+def test_lazy_interest(monkeypatch):
+    bank = Bank('Ninth Bank and Trust', shards=4)
+    bank_name = bank.name
+    Jeff = Customer(bank_name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsSavings = SavingsAccount(bank_name, Jeff.customer_id, 1000)
+    JeffsCard = CreditCard(bank_name, Jeff.customer_id)
+    JeffsCard.spend(300, JeffsCard.cvv)
+    eager = Bank('Tenth Bank and Trust')
+    EagerSavings = SavingsAccount(eager.name, Jeff.customer_id, 1000)
+    EagerCard = CreditCard(eager.name, Jeff.customer_id)
+    EagerCard.spend(300, EagerCard.cvv)
+
+    written = record_writes(monkeypatch)
+    for _ in range(3):
+        bank.next_month()
+        EagerSavings.next_month()
+        EagerCard.next_month()
+    assert [file for file in written if str(file).startswith(str(banking.banking.file_path/bank_name))] == [bank._file]*3
+    assert JeffsSavings.balance == EagerSavings.balance
+    assert JeffsSavings._balance == EagerSavings._balance
+    assert JeffsCard.current_balance == EagerCard.current_balance
+    assert JeffsCard._current_balance == EagerCard._current_balance
+
+    bank.next_month()
+    EagerSavings.next_month()
+    EagerCard.next_month()
+    assert bank.sweep() == 2
+    assert bank.sweep() == 0
+    bank.next_month()
+    EagerSavings.next_month()
+    bank.close()
+    reopened = Bank.open(bank_name)
+    assert reopened.period == 5
+    savings = reopened.account(JeffsSavings.account_id)
+    assert savings is not JeffsSavings
+    assert savings._balance != EagerSavings._balance
+    assert savings.balance == EagerSavings.balance
+    assert savings._balance == EagerSavings._balance
+
+def test_sweep_resumes(monkeypatch):
+    bank = Bank('Sixteenth Bank and Trust', shards=4)
+    Jeff = Customer(bank.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    accounts = [SavingsAccount(bank.name, Jeff.customer_id, 1000) for _ in range(10)]
+    bank.next_month()
+    #The sweep reads shards by their index, records are looked up by their id
+    read = []
+    shard_file = banking.banking.shard_file
+    monkeypatch.setattr(banking.banking, 'shard_file', lambda bank_name, entity, key, shards:
+                        (read.append((entity, key)) if key < shards else None, shard_file(bank_name, entity, key, shards))[1])
+    swept = [bank.sweep(limit=3) for _ in range(5)]
+    assert swept == [3, 3, 3, 1, 0]
+    #Each call after the first starts again at the shard the last one stopped in
+    assert len(read) == 2*4 + 3
+    assert all(account._period == 1 and account._balance == accounts[0]._balance > 1000 for account in accounts)
+
+def test_card_risk_rules():
+    risk_log = pathlib.Path(banking.banking.riskhandler.baseFilename)
+    start = risk_log.stat().st_size
+    bank = Bank('Eleventh Bank and Trust', shards=4)
+    bank_name = bank.name
+    bank.risk_rules = banking.banking.RiskRules(purchases_per_minute=3, amount_per_hour=500, cvv_failures=2)
+    Jeff = Customer(bank_name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsCard = CreditCard(bank_name, Jeff.customer_id)
+    JeffsCard.spend(300, JeffsCard.cvv)
+    with pytest.raises(ValueError) as execinfo:
+        JeffsCard.spend(201, JeffsCard.cvv)
+    assert str(execinfo.value) == 'The purchase was declined. The card has spent too much in the last hour'
+    JeffsCard.spend(100, JeffsCard.cvv)
+    JeffsCard.spend(100, JeffsCard.cvv)
+    with pytest.raises(ValueError) as execinfo:
+        JeffsCard.spend(1, JeffsCard.cvv)
+    assert str(execinfo.value) == 'The purchase was declined. The card has made too many purchases in the last minute'
+    assert JeffsCard.current_balance == '$500.00'
+
+    JanesCard = CreditCard(bank_name, Jeff.customer_id)
+    for _ in range(2):
+        with pytest.raises(ValueError) as execinfo:
+            JanesCard.spend(1, JanesCard.cvv+1)
+        assert str(execinfo.value) == 'The CVV supplied does not match, transaction declined'
+    with pytest.raises(ValueError) as execinfo:
+        JanesCard.spend(1, JanesCard.cvv)
+    assert str(execinfo.value) == 'The card is locked after repeated CVV failures, transaction declined'
+    assert banking.banking.json_load(bank._file)['Risk Rules']['CVV Failures'] == 2
+
+    with risk_log.open('r') as f:
+        f.seek(start)
+        decisions = [json.loads(line.split(' - ', 2)[2]) for line in f if bank_name in line]
+    assert [decision['Decision'] for decision in decisions] == ['Approved', 'Declined', 'Approved', 'Approved', 'Declined', 'Declined', 'Declined', 'Declined']
+
+    #Cards used by bank name alone follow the rules kept in the manifest
+    bank.close()
+    LatersCard = CreditCard(bank_name, Jeff.customer_id)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            LatersCard.spend(1, LatersCard.cvv+1)
+    with pytest.raises(ValueError) as execinfo:
+        LatersCard.spend(1, LatersCard.cvv)
+    assert str(execinfo.value) == 'The card is locked after repeated CVV failures, transaction declined'
+
+
+def test_sliding_window():
+    window = banking.banking.SlidingWindow(60, buckets=6)
+    window.add(0, 5)
+    window.add(30, 1)
+    assert window.total(59) == 6
+    assert window.total(65) == 1
+    assert window.total(500) == 0
+
+def test_registry():
+    bank = Bank('Twelfth Bank and Trust', shards=4)
+    other = Bank('Thirteenth Bank and Trust', shards=4)
+    bank.risk_rules = banking.banking.RiskRules(cvv_failures=1)
+    banking.banking.registry(bank.name)._keep = 2
+    Jeff = Customer(bank.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    customer_id = Jeff.customer_id
+    account_ids = [CheckingAccount(bank.name, customer_id, 100*i).account_id for i in range(10)]
+    card = CreditCard(bank.name, customer_id)
+    card_number, cvv = card._card_number, card.cvv
+    with pytest.raises(ValueError):
+        card.spend(1, cvv+1)
+    OthersChecking = CheckingAccount(other.name, customer_id, 100)
+    del Jeff, card
+    gc.collect()
+    assert len(banking.banking.registry(bank.name)) == 2
+
+    account = bank.account(account_ids[3])
+    assert account._balance == 300 and bank.account(account_ids[3]) is account
+    bank.evict(account)
+    assert bank.account(account_ids[3]) is not account
+    assert bank.customer(customer_id)._lname == 'Abe'
+    with pytest.raises(ValueError) as execinfo:
+        bank.card(card_number).spend(1, cvv)
+    assert str(execinfo.value) == 'The card is locked after repeated CVV failures, transaction declined'
+    with pytest.raises(ValueError) as execinfo:
+        bank.account(1)
+    assert str(execinfo.value) == f'Account 1 does not exist at {bank.name}'
+
+    bank.close()
+    assert bank.name not in banking.banking._REGISTRIES
+    assert OthersChecking in CheckingAccount.__ACCOUNTS__
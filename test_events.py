@@ -0,0 +1,150 @@
+import banking.banking
+from banking.banking import Bank, SavingsAccount, CheckingAccount, Customer, CreditCard, batch
+from banking import events
+
+
+def test_event_stream():
+    bank = Bank('Event Bank', shards=4)
+    received = []
+    events.subscribe(received.append, types=['balance_changed'])
+    try:
+        Jeff = Customer(bank.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+        Jeff.address = '5678 Elm st'
+        JeffsSavings = SavingsAccount(bank.name, Jeff.customer_id, 1200)
+        JeffsChecking = CheckingAccount(bank.name, Jeff.customer_id, 100)
+        JeffsCard = CreditCard(bank.name, Jeff.customer_id)
+        JeffsChecking.deposit(50)
+        JeffsCard.spend(30, JeffsCard.cvv)
+        JeffsCard.pay(JeffsChecking.account_id, 30)
+        bank.next_month()
+        JeffsSavings.withdraw(100)
+    finally:
+        events.unsubscribe(received.append)
+
+    stream = bank.events
+    read = stream.read('warehouse', limit=4)
+    assert [event['Type'] for event in read] == ['customer_created', 'customer_updated', 'account_opened', 'account_opened']
+    assert [event['Seq'] for event in read] == [1, 2, 3, 4]
+    assert 'SSN' not in read[0]['Data']
+    stream.commit('warehouse')
+    assert stream.offset('warehouse') == 4
+
+    read = stream.read('warehouse')
+    assert [event['Type'] for event in read] == ['card_opened', 'balance_changed', 'card_spend', 'balance_changed', 'card_payment',
+                                                 'month_rollover', 'balance_changed', 'balance_changed']
+    assert [event['Data']['Reason'] for event in received] == ['deposit', 'withdrawal', 'interest', 'withdrawal']
+    assert received[2]['Data']['Balance'] == 1200.5
+    assert stream.read('warehouse') == []
+
+    #Uncommitted reads are read again after a restart, committed ones are not
+    bank.close()
+    stream = Bank.open('Event Bank').events
+    assert stream.read('warehouse')[0]['Type'] == 'card_opened'
+    assert stream.read('notifications')[0]['Seq'] == 1
+
+
+def test_events_follow_batch():
+    bank = Bank('Batched Event Bank', shards=4)
+    Jeff = Customer(bank.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsChecking = CheckingAccount(bank.name, Jeff.customer_id, 100)
+    received = []
+    events.subscribe(received.append)
+    try:
+        with batch():
+            JeffsChecking.deposit(10)
+            JeffsChecking.deposit(20)
+            assert received == []
+    finally:
+        events.unsubscribe(received.append)
+    assert [event['Data']['Balance'] for event in received] == [110, 130]
+    assert [event['Seq'] for event in received] == [3, 4]
+
+    #A partly written event left by a crash is dropped when the stream is opened again
+    bank.close()
+    with (banking.banking.file_path/bank.name/'events.log').open('a') as f:
+        f.write('{"Seq": 5, "Ty')
+    reopened = Bank.open(bank.name)
+    stream = reopened.events
+    assert len(stream.read('warehouse')) == 4
+    JeffsChecking = reopened.account(JeffsChecking.account_id)
+    JeffsChecking.deposit(1)
+    assert stream.read('warehouse')[0]['Seq'] == 5
+
+
+def test_events_outbox_recovery(monkeypatch):
+    bank = Bank('Outbox Event Bank', shards=4)
+    Jeff = Customer(bank.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsChecking = CheckingAccount(bank.name, Jeff.customer_id, 100)
+    account_id = JeffsChecking.account_id
+
+    #A crash after the shard is written but before its event is appended, the event is appended when the bank reopens
+    def crash(self):
+        raise RuntimeError('crashed')
+    release = events.EventStream.release
+    monkeypatch.setattr(events.EventStream, 'release', crash)
+    try:
+        JeffsChecking.deposit(50)
+    except RuntimeError:
+        pass
+    monkeypatch.setattr(events.EventStream, 'release', release)
+    assert (banking.banking.file_path/bank.name/'outbox.json').exists()
+    bank.close()
+    reopened = Bank.open(bank.name)
+    read = reopened.events.read('warehouse')
+    assert [event['Type'] for event in read] == ['customer_created', 'account_opened', 'balance_changed']
+    assert read[-1]['Data']['Balance'] == 150
+    reopened.events.commit('warehouse')
+    assert not (banking.banking.file_path/bank.name/'outbox.json').exists()
+
+    #A crash before the shard is written, the shard and the event are both redone when the bank reopens
+    JeffsChecking = reopened.account(account_id)
+    record = dict(banking.banking.shard_load(JeffsChecking._file)[str(account_id)], Balance=175)
+    reopened.events.stage([events.change(bank.name, 'balance_changed', {'Account Id':account_id, 'Balance':175})],
+                          [{'File':JeffsChecking._file, 'Records':{str(account_id):record}}])
+    reopened.close()
+    reopened = Bank.open(bank.name)
+    assert reopened.account(account_id)._balance == 175
+    assert [event['Seq'] for event in reopened.events.read('warehouse')] == [4]
+
+
+def test_events_batch_redone(monkeypatch):
+    bank = Bank('Redone Event Bank', shards=4)
+    Jeff = Customer(bank.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsChecking = CheckingAccount(bank.name, Jeff.customer_id, 100)
+    JeffsSavings = SavingsAccount(bank.name, Jeff.customer_id, 1000)
+    assert JeffsChecking._file != JeffsSavings._file
+    bank.events.read('warehouse')
+    bank.events.commit('warehouse')
+
+    #The batch fails after the checking shard is written, the savings shard is written again from the outbox
+    json_write = banking.banking.json_write
+    def failing_write(file, data, changed=None):
+        if file == JeffsSavings._file and getattr(banking.banking._batch, 'pending', None) is None:
+            raise OSError('disk full')
+        json_write(file, data, changed)
+    monkeypatch.setattr(banking.banking, 'json_write', failing_write)
+    with batch():
+        JeffsChecking.deposit(50)
+        JeffsSavings.deposit(50)
+    monkeypatch.setattr(banking.banking, 'json_write', json_write)
+    assert banking.banking.shard_load(JeffsSavings._file)[str(JeffsSavings.account_id)]['Balance'] == 1050
+    assert not (banking.banking.file_path/bank.name/'outbox.json').exists()
+    assert [event['Data']['Balance'] for event in bank.events.read('warehouse')] == [150, 1050]
+    bank.events.commit('warehouse')
+
+    #Nor can the outbox be redone, the batch is finished by the next one
+    def failing_redo(self):
+        raise OSError('disk full')
+    redo = events.EventStream.redo
+    monkeypatch.setattr(banking.banking, 'json_write', failing_write)
+    monkeypatch.setattr(events.EventStream, 'redo', failing_redo)
+    JeffsSavings.deposit(50)
+    monkeypatch.setattr(banking.banking, 'json_write', json_write)
+    monkeypatch.setattr(events.EventStream, 'redo', redo)
+    assert (banking.banking.file_path/bank.name/'outbox.json').exists()
+    JeffsChecking.deposit(5)
+    bank.close()
+    reopened = Bank.open(bank.name)
+    assert reopened.account(JeffsSavings.account_id)._balance == 1100
+    assert reopened.account(JeffsChecking.account_id)._balance == 155
+    assert [event['Data']['Balance'] for event in reopened.events.read('warehouse')] == [1100, 155]
@@ -0,0 +1,93 @@
+import tempfile
+import threading
+import banking.banking
+from banking import events
+from banking.server import BankServer, BankClient
+import pytest
+
+
+def test_server():
+    address = tempfile.mkdtemp() + '/banking.sock'
+    server = BankServer(address, batch_window=0.01)
+    server.start()
+    client = BankClient(address)
+    bank_name = 'Server Bank and Trust'
+    assert client.create('bank', bank_name, shards=4) == bank_name
+    customer_id = client.create('customer', bank_name, ssn=123456789, fname='Jeff', lname='Abe', address='1234 Main st')
+    account_id = client.create('checking', bank_name, customer_id=customer_id, starting_balance=100)
+    card = client.create('card', bank_name, customer_id=customer_id)
+
+    written = []
+    json_write = banking.banking.json_write
+    banking.banking.json_write = lambda file, data, changed=None: (getattr(banking.banking._batch, 'pending', None) is None and written.append(file), json_write(file, data, changed))
+    try:
+        threads = [threading.Thread(target=lambda: [client.deposit(bank_name, account_id, 1) for _ in range(10)]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        banking.banking.json_write = json_write
+    assert client.balance(bank_name, account_id=account_id) == 180
+    assert len(written) < 80
+
+    client.spend(bank_name, card['card_number'], 50, card['cvv'])
+    with pytest.raises(ValueError) as execinfo:
+        client.spend(bank_name, card['card_number'], 50, card['cvv']+1)
+    assert str(execinfo.value) == 'The CVV supplied does not match, transaction declined'
+    assert client.pay(bank_name, card['card_number'], account_id, 50) == 0
+    assert client.withdraw(bank_name, account_id, 200) == 130
+    client.close()
+    server.stop()
+
+    server = BankServer(address)
+    server.start()
+    client = BankClient(address)
+    assert client.balance(bank_name, account_id=account_id) == 130
+    assert client.balance(bank_name, card_number=card['card_number']) == {'statement_balance':0, 'current_balance':0}
+    client.close()
+    server.stop()
+
+
+def test_server_failed_commit():
+    address = tempfile.mkdtemp() + '/banking.sock'
+    server = BankServer(address, batch_window=0.001)
+    server.start()
+    client = BankClient(address)
+    bank_name = 'Failing Server Bank'
+    client.create('bank', bank_name, shards=4)
+    customer_id = client.create('customer', bank_name, ssn=123456789, fname='Jeff', lname='Abe', address='1234 Main st')
+    account_id = client.create('checking', bank_name, customer_id=customer_id, starting_balance=100)
+
+    stage = events.EventStream.stage
+    def failing_stage(self, published, changes):
+        raise OSError('disk full')
+    events.EventStream.stage = failing_stage
+    try:
+        with pytest.raises(ValueError) as execinfo:
+            client.deposit(bank_name, account_id, 50)
+        assert str(execinfo.value) == 'The operation could not be committed, nothing was written: disk full'
+    finally:
+        events.EventStream.stage = stage
+    assert client.balance(bank_name, account_id=account_id) == 100
+    assert client.deposit(bank_name, account_id, 50) == 150
+
+    #A write that fails once the batch is staged is redone from the outbox, the caller is told it went through
+    json_write = banking.banking.json_write
+    def failing_write(file, data, changed=None):
+        if getattr(banking.banking._batch, 'pending', None) is None:
+            raise OSError('disk full')
+        json_write(file, data, changed)
+    banking.banking.json_write = failing_write
+    try:
+        assert client.deposit(bank_name, account_id, 50) == 200
+    finally:
+        banking.banking.json_write = json_write
+    client.close()
+    server.stop()
+    server = BankServer(address, batch_window=0.001)
+    server.start()
+    client = BankClient(address)
+    assert client.balance(bank_name, account_id=account_id) == 200
+    client.close()
+    server.stop()
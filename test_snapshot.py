@@ -0,0 +1,108 @@
+import banking.banking
+from banking.banking import Bank, SavingsAccount, CheckingAccount, Customer, CreditCard
+from banking.snapshot import Snapshot, snapshot_save, snapshot_restore
+import numpy as np
+import pytest
+
+
+def test_snapshot_round_trip():
+    bank = Bank('Snapshot Bank and Trust', shards=4)
+    bank_name = bank.name
+    Jeff = Customer(bank_name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    Jane = Customer(bank_name, 987654321, 'Jane', 'Doe', '5678 Élm st')
+    SavingsAccount(bank_name, Jeff.customer_id, 700)
+    CheckingAccount(bank_name, Jane.customer_id, 150)
+    JanesCard = CreditCard(bank_name, Jane.customer_id)
+    JanesCard.spend(100.5, JanesCard.cvv)
+    file = snapshot_save(bank_name)
+
+    snapshot = Snapshot.load(file)
+    assert snapshot.rows['Accounts'] == 2
+    assert isinstance(snapshot.tables['Accounts']['Balance'], np.ndarray)
+    assert snapshot.tables['Customers']['Address'][1] == '5678 Élm st'
+    assert snapshot.masks['Accounts']['Minimum Balance'].tolist() == [True, False]
+
+    data = banking.banking.bank_export(bank_name)
+    assert snapshot.to_json() == data
+    snapshot.bank_name = 'Restored Bank and Trust'
+    snapshot.save(file)
+    assert snapshot_restore(file) == 'Restored Bank and Trust'
+    restored = banking.banking.bank_export('Restored Bank and Trust')
+    assert restored['Credit Cards'] == data['Credit Cards']
+    assert restored['Customers'] == data['Customers']
+
+    #The restored bank reads its records from the snapshot and only writes the shards of the records that change
+    folder = banking.banking.file_path/'Restored Bank and Trust'
+    assert sorted(file.name for file in folder.iterdir()) == ['snapshot.snap']
+    restored = Bank.open('Restored Bank and Trust')
+    checking = restored.account(data['Accounts'][1]['Account Id'])
+    assert isinstance(checking, CheckingAccount) and checking._balance == 150
+    checking.deposit(25)
+    assert [file.name for file in folder.glob('accounts-*.json')] == [checking._file.name]
+    assert banking.banking.shard_load(checking._file)[str(checking.account_id)]['Customer Id'] == Jane.customer_id
+    with pytest.raises(ValueError):
+        Customer(restored.name, 987654321, 'Jane', 'Doe', '5678 Élm st')
+    assert Customer(restored.name, 111223333, 'Joe', 'Bloggs', '1 High st').customer_id == 10003
+    restored.close()
+    exported = banking.banking.bank_export('Restored Bank and Trust')
+    assert [account['Balance'] for account in exported['Accounts']] == [700, 175]
+    assert len(exported['Customers']) == 3
+
+    #Saving the restored bank lays the records written since over the snapshot it was restored from
+    resaved = Snapshot.load(snapshot_save('Restored Bank and Trust'))
+    assert resaved.to_json() == exported
+    assert resaved.masks['Accounts']['Minimum Balance'].tolist() == [True, False]
+
+
+def test_snapshot_keeps_bank_settings():
+    bank = Bank('Period Bank and Trust', shards=4)
+    bank.risk_rules = banking.banking.RiskRules(purchases_per_minute=3, amount_per_hour=500, cvv_failures=2)
+    Jeff = Customer(bank.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsSavings = SavingsAccount(bank.name, Jeff.customer_id, 1200)
+    bank.next_month()
+    bank.next_month()
+    assert JeffsSavings.balance == f'Customer {Jeff.customer_id} Balance is: $1,201.00'
+    file = snapshot_save(bank.name)
+
+    #Interest carries on from the month the bank was on and the risk rules are kept, for an imported bank and a restored one
+    data = banking.banking.bank_export(bank.name)
+    data['Bank Name'] = 'Imported Period Bank'
+    banking.banking.bank_import(data)
+    snapshot = Snapshot.load(file)
+    assert snapshot.period == 2
+    snapshot.bank_name = 'Restored Period Bank'
+    snapshot.save(file)
+    snapshot_restore(file)
+    for name in ['Imported Period Bank', 'Restored Period Bank']:
+        copy = Bank.open(name)
+        assert copy.period == 2
+        assert copy.risk_rules.to_dict() == bank.risk_rules.to_dict()
+        copy.next_month()
+        assert copy.account(JeffsSavings.account_id).balance == f'Customer {Jeff.customer_id} Balance is: $1,201.50'
+
+
+def test_snapshot_replaces_open_bank():
+    bank = Bank('Open Bank and Trust', shards=4)
+    Jeff = Customer(bank.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsChecking = CheckingAccount(bank.name, Jeff.customer_id, 100)
+    file = snapshot_save(bank.name)
+    data = banking.banking.bank_export(bank.name)
+
+    #Restoring over the open bank closes it, the bank opened again reads the restored balance and keeps its writes
+    for restore in [lambda: snapshot_restore(file), lambda: banking.banking.bank_import(data)]:
+        bank = Bank.open('Open Bank and Trust')
+        bank.account(JeffsChecking.account_id).deposit(900)
+        restore()
+        assert all(open_bank is not bank for open_bank in Bank.__BANKS__)
+        reopened = Bank.open('Open Bank and Trust')
+        reopened.account(JeffsChecking.account_id).deposit(5)
+        reopened.close()
+        assert banking.banking.bank_export('Open Bank and Trust')['Accounts'][0]['Balance'] == 105
+
+
+def test_snapshot_bad_file():
+    file = banking.banking.file_path/'not a snapshot.snap'
+    file.write_bytes(b'0'*64)
+    with pytest.raises(ValueError) as execinfo:
+        Snapshot.load(file)
+    assert str(execinfo.value) == f'{file} is not a version 1 bank snapshot'
@@ -0,0 +1,140 @@
+import gc
+import banking.banking
+from banking.banking import Bank, SavingsAccount, CheckingAccount, Customer
+from banking.transfers import TransferEngine
+import pytest
+
+
+class Crash(BaseException):
+    '''Stands in for the process dying, an error the engine does not catch'''
+
+
+def test_transfers():
+    first = Bank('First Transfer Bank', shards=4)
+    second = Bank('Second Transfer Bank', shards=4)
+    Jeff = Customer(first.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsSavings = SavingsAccount(first.name, Jeff.customer_id, 1000)
+    JeffsChecking = CheckingAccount(first.name, Jeff.customer_id, 100)
+    Jane = Customer(second.name, 987654321, 'Jane', 'Doe', '5678 Elm st')
+    JanesChecking = CheckingAccount(second.name, Jane.customer_id, 0)
+    engine = TransferEngine()
+
+    engine.transfer(first.name, JeffsSavings.account_id, first.name, JeffsChecking.account_id, 200)
+    assert JeffsSavings._balance == 800 and JeffsChecking._balance == 300
+    engine.transfer(first.name, JeffsChecking.account_id, first.name, JeffsChecking.account_id, 40)
+    assert JeffsChecking._balance == 300 and JeffsChecking._holds == {}
+    with pytest.raises(ValueError) as execinfo:
+        engine.transfer(first.name, JeffsSavings.account_id, second.name, JanesChecking.account_id, 301)
+    assert str(execinfo.value) == f'The account {JeffsSavings.account_id} cannot withstand a transfer of $301.00'
+
+    keys = [engine.submit(first.name, JeffsChecking.account_id, second.name, JanesChecking.account_id, 10) for _ in range(31)]
+    results = engine.flush()
+    assert [results[key] for key in keys].count('committed') == 30
+    assert JeffsChecking._balance == 0 and JanesChecking._balance == 300
+    assert JeffsChecking._holds == {} and JanesChecking._holds == {}
+    data = banking.banking.bank_export(second.name)
+    assert data['Accounts'][0]['Balance'] == 300
+
+
+def test_transfer_recovery():
+    first = Bank('Third Transfer Bank', shards=4)
+    second = Bank('Fourth Transfer Bank', shards=4)
+    Jeff = Customer(first.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsChecking = CheckingAccount(first.name, Jeff.customer_id, 100)
+    JanesChecking = CheckingAccount(second.name, Jeff.customer_id, 0)
+    logs = banking.banking.file_path/'recovery test'
+
+    class CrashBeforeCommit(TransferEngine):
+        def _prepare_credit(self, transfer):
+            raise Crash()
+    crashed = CrashBeforeCommit(logs)
+    with pytest.raises(Crash):
+        crashed.transfer(first.name, JeffsChecking.account_id, second.name, JanesChecking.account_id, 40)
+    assert JeffsChecking._balance == 60 and JanesChecking._balance == 0
+    #A batch is only recovered once the engine running it is gone
+    engine = TransferEngine(logs)
+    assert engine.recover() == 0 and JeffsChecking._balance == 60
+    crashed.close()
+    assert engine.recover() == 1
+    assert JeffsChecking._balance == 100 and JanesChecking._balance == 0 and JeffsChecking._holds == {}
+
+    class CrashAfterCommit(TransferEngine):
+        def _finish(self, transfers, commit):
+            raise Crash()
+    crashed = CrashAfterCommit(logs)
+    with pytest.raises(Crash):
+        crashed.transfer(first.name, JeffsChecking.account_id, second.name, JanesChecking.account_id, 40)
+    assert JeffsChecking._balance == 60 and JanesChecking._balance == 0
+    #Batches the live engine finishes later do not clear the unfinished one
+    engine.transfer(first.name, JeffsChecking.account_id, second.name, JanesChecking.account_id, 10)
+    crashed.close()
+    assert TransferEngine(logs).recover() == 0
+    assert JeffsChecking._balance == 50 and JanesChecking._balance == 50
+    assert JeffsChecking._holds == {} and JanesChecking._holds == {}
+
+    #A batch that fails while its engine keeps running is aborted straight away, not left held until recovery
+    class FailOnce(TransferEngine):
+        fail = True
+        def _prepare_credit(self, transfer):
+            if self.fail:
+                self.fail = False
+                raise OSError('disk full')
+            super()._prepare_credit(transfer)
+    failing = FailOnce(logs)
+    with pytest.raises(OSError):
+        failing.transfer(first.name, JeffsChecking.account_id, second.name, JanesChecking.account_id, 40)
+    assert JeffsChecking._balance == 50 and JeffsChecking._holds == {}
+    failing.transfer(first.name, JeffsChecking.account_id, second.name, JanesChecking.account_id, 10)
+    assert JeffsChecking._balance == 40 and JanesChecking._balance == 60
+    failing.close()
+    assert engine.recover() == 0
+    assert JeffsChecking._balance == 40 and JanesChecking._balance == 60
+    engine.close()
+    assert not list(logs.glob('*.log'))
+
+
+def test_transfer_recovery_declined():
+    first = Bank('Sixth Transfer Bank', shards=4)
+    Jeff = Customer(first.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    JeffsChecking = CheckingAccount(first.name, Jeff.customer_id, 100)
+    JeffsSavings = SavingsAccount(first.name, Jeff.customer_id, 500)
+    logs = banking.banking.file_path/'declined test'
+
+    class CrashAfterCommit(TransferEngine):
+        def _finish(self, transfers, commit):
+            raise Crash()
+    crashed = CrashAfterCommit(logs)
+    crashed.submit(first.name, JeffsChecking.account_id, first.name, JeffsSavings.account_id, 40)
+    crashed.submit(first.name, JeffsChecking.account_id, first.name, 424242, 10)
+    with pytest.raises(Crash):
+        crashed.flush()
+    crashed.close()
+
+    #The transfer to an account that does not exist was declined, recovery only finishes the prepared one
+    engine = TransferEngine(logs)
+    assert JeffsChecking._balance == 60 and JeffsSavings._balance == 540
+    assert JeffsChecking._holds == {} and JeffsSavings._holds == {}
+    engine.transfer(first.name, JeffsChecking.account_id, first.name, JeffsSavings.account_id, 10)
+    assert JeffsChecking._balance == 50 and JeffsSavings._balance == 550
+    engine.close()
+    assert not list(logs.glob('*.log'))
+
+
+def test_transfer_closed_banks():
+    first = Bank('Fifth Transfer Bank', shards=4)
+    Jeff = Customer(first.name, 123456789, 'Jeff', 'Abe', '1234 Main st')
+    from_id = CheckingAccount(first.name, Jeff.customer_id, 100).account_id
+    to_id = CheckingAccount(first.name, Jeff.customer_id, 0).account_id
+    first.close()
+    del first
+    gc.collect()
+
+    TransferEngine().transfer('Fifth Transfer Bank', from_id, 'Fifth Transfer Bank', to_id, 40)
+    gc.collect()
+    assert all(bank.name != 'Fifth Transfer Bank' for bank in Bank.__BANKS__)
+    reopened = Bank.open('Fifth Transfer Bank')
+    assert reopened.account(from_id)._balance == 60 and reopened.account(to_id)._balance == 40
+
+    reopened.destroy()
+    assert not (banking.banking.file_path/'Fifth Transfer Bank.json').exists()
+    assert not (banking.banking.file_path/'Fifth Transfer Bank').exists()
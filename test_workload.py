@@ -0,0 +1,28 @@
+import banking.banking
+from banking.workload import generate, save_trace, load_trace, replay
+import pytest
+
+
+def test_generate():
+    trace = generate(seed=7, banks=2, customers=20, operations=500, ops_per_month=100)
+    assert trace == generate(seed=7, banks=2, customers=20, operations=500, ops_per_month=100)
+    assert trace != generate(seed=8, banks=2, customers=20, operations=500, ops_per_month=100)
+    assert [entry['Op'] for entry in trace[1:]].count('next_month') == 8
+    file = banking.banking.file_path/'workload test.jsonl'
+    save_trace(trace, file)
+    assert load_trace(file) == trace
+    with pytest.raises(ValueError):
+        file.write_text('{"Op": "bank"}\n')
+        load_trace(file)
+
+
+def test_replay():
+    trace = generate(seed=7, customers=20, operations=300, ops_per_month=100)
+    report = replay(trace, banks=['Workload Replay Bank'])
+    assert report['Operations'] == len([entry for entry in trace[1:] if entry['Op'] in ('deposit', 'withdraw', 'spend', 'pay', 'next_month')])
+    assert sum(report['Counts'].values()) == report['Operations']
+    assert report['Latency p50'] <= report['Latency p99'] <= report['Latency max']
+    assert banking.banking.bank_export('Workload Replay Bank')['Customers'][0]['SSN'] == 100000000
+
+    report = replay(trace, rate=2000, banks=['Workload Rate Bank'])
+    assert report['Seconds'] >= (report['Operations']-1)/2000